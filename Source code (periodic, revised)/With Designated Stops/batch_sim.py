@@ -0,0 +1,112 @@
+import numpy as np
+
+from road import Road
+from sidewalk import Sidewalk
+from vehicle_sim import IntraRoadSimulator
+from passenger_sim import Passenger_Simulator
+from main_sim import IntegratedSimulator
+from vehicle_state import VehicleStateBatch
+import parallel_update
+
+
+class BatchSimulator:
+    """Runs several independent replicas (trials) of the same parameter point in lockstep.
+    The road and sidewalk grids and the vehicle state of all replicas are stacked along a leading replica axis, so the
+    vectorized update rules process every replica in one NumPy pass. Each replica keeps its own IntegratedSimulator
+    for the per-vehicle rules, the passengers and the result tables, and draws its random numbers from its own generator
+    (rngs, one np.random.Generator per replica, otherwise generators spawned from np.random.SeedSequence(seed)), so a replica
+    does not depend on the others."""
+
+    def __init__(self, num_replicas, road_length, road_width, speed_limit, allowed_rows, sidewalk_length, sidewalk_width, max_passengers_per_cell, passenger_arrival_rate, rngs=None, seed=None):
+        self.road_occupancy = np.zeros((num_replicas, road_length, road_width))
+        self.sidewalk_occupancy = np.zeros((num_replicas, sidewalk_length, sidewalk_width), dtype=int)
+        self.state = None #VehicleStateBatch, built once the vehicles of every replica are initialized
+        self.simulators = []
+        if rngs is None:
+            rngs = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(num_replicas)]
+        for replica in range(num_replicas):
+            sidewalk = Sidewalk(length=sidewalk_length, width=sidewalk_width, max_passengers_per_cell=max_passengers_per_cell)
+            road = Road(length=road_length, width=road_width, speed_limit=speed_limit, allowed_rows=allowed_rows)
+            road.occupancy = self.road_occupancy[replica] #Each replica works on its own slice of the stacked grids
+            sidewalk.occupancy = self.sidewalk_occupancy[replica]
+            vehicle_simulator = IntraRoadSimulator(road=road, state_backend="arrays", rng=rngs[replica])
+            pedestrian_simulator = Passenger_Simulator(sidewalk=sidewalk, passenger_arrival_rate=passenger_arrival_rate, road_designation=road,
+                                                       max_passengers_per_cell=max_passengers_per_cell, vehicle_simulator=vehicle_simulator)
+            self.simulators.append(IntegratedSimulator(vehicle_simulator=vehicle_simulator, pedestrian_simulator=pedestrian_simulator, update_mode="parallel"))
+
+    def run_simulation(self, max_timesteps, transient_time, density, truck_fraction, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows, recording_policy=None):
+        """Same inputs as IntegratedSimulator.run_simulation, returns the list of result tables of every replica.
+        recording_policy is one RecordingPolicy for every replica, or a list with the policy of each replica"""
+        if not isinstance(recording_policy, (list, tuple)):
+            recording_policy = [recording_policy] * len(self.simulators)
+        for simulator, replica_recording_policy in zip(self.simulators, recording_policy):
+            simulator.start_run(density, truck_fraction, stop_to_stop_distance, max_timesteps, transient_time, replica_recording_policy)
+        self.state = VehicleStateBatch([simulator.vehicle_simulator.state for simulator in self.simulators])
+
+        timestep = 0
+        while timestep < max_timesteps:
+            stepping_replicas = []
+            for replica, simulator in enumerate(self.simulators):
+                simulator.begin_timestep(timestep)
+                if simulator.road_is_being_populated():
+                    simulator.populate_the_road(simulator.pedestrian_simulator.sidewalk, timestep, transient_time, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows)
+                else:
+                    stepping_replicas.append(replica)
+            self.parallel_simulation_step(stepping_replicas, timestep, transient_time)
+            for simulator in self.simulators:
+                simulator.end_timestep(timestep, max_timesteps, transient_time)
+            timestep += 1
+        return [simulator.collect_results(timestep) for simulator in self.simulators]
+
+    def parallel_simulation_step(self, stepping_replicas, timestep, transient_time):
+        """IntegratedSimulator.parallel_simulation_step for many replicas: the flags and the vectorized moves are computed
+        for all replicas at once, the per-vehicle fallback and the bookkeeping stay per replica"""
+        replicas, slots, lane_change_rolls, fallback_orders = [], [], [], {}
+        for replica in stepping_replicas:
+            simulator = self.simulators[replica]
+            fallback_order, replica_lane_change_rolls = simulator.begin_parallel_step()
+            count = simulator.vehicle_simulator.state.count
+            if count > 0:
+                fallback_orders[replica] = fallback_order
+                replicas.append(np.full(count, replica))
+                slots.append(np.arange(count))
+                lane_change_rolls.append(replica_lane_change_rolls)
+        if not fallback_orders:
+            return
+        replicas, slots, lane_change_rolls = np.concatenate(replicas), np.concatenate(slots), np.concatenate(lane_change_rolls)
+
+        needs_sequential_update = parallel_update.needs_sequential_update(self.road_occupancy, self.sidewalk_occupancy, self.state, replicas, slots, lane_change_rolls)
+        for replica, fallback_order in fallback_orders.items():
+            in_replica = replicas == replica
+            self.simulators[replica].update_sequential_vehicles(timestep, transient_time, fallback_order, lane_change_rolls[in_replica], needs_sequential_update[in_replica])
+
+        bulk = ~needs_sequential_update
+        parallel_update.advance(self.road_occupancy, self.state, replicas[bulk], slots[bulk], [simulator.rng for simulator in self.simulators])
+        for replica in fallback_orders:
+            simulator = self.simulators[replica]
+            bulk_slots = slots[bulk & (replicas == replica)]
+            simulator.vehicle_simulator.after_parallel_update(bulk_slots)
+            simulator.finish_parallel_step(timestep, transient_time, bulk_slots)
+
+
+def run_trials(params, rngs, recording_policies, update_mode, road_length, road_width, speed_limit, sidewalk_width, max_passengers_per_cell, passenger_arrival_rate, max_timesteps, transient_time, density, truck_fraction, stop_to_stop_distance):
+    """Runs the trials of one parameter point of a case parameter module (params), one per generator of rngs with the
+    RecordingPolicy of the same position: a single trial on one IntegratedSimulator in the "sequential" update mode,
+    every trial as one BatchSimulator in the "parallel" one. Returns the list of result tables of every trial."""
+    run_args = (max_timesteps, transient_time, density, truck_fraction, stop_to_stop_distance,
+                params.safe_stopping_speed, params.safe_deceleration, params.jeepney_allowed_rows, params.truck_allowed_rows)
+    if update_mode == "sequential":
+        if len(rngs) != 1:
+            raise ValueError(f"The sequential update mode runs one trial at a time, got {len(rngs)}")
+        sidewalk = Sidewalk(length=road_length, width=sidewalk_width, max_passengers_per_cell=max_passengers_per_cell)
+        road = Road(length=road_length, width=road_width, speed_limit=speed_limit, allowed_rows=params.allowed_rows_input)
+        vehicle_simulator = IntraRoadSimulator(road=road, rng=rngs[0])
+        pedestrian_simulator = Passenger_Simulator(sidewalk=sidewalk, passenger_arrival_rate=passenger_arrival_rate, road_designation=road,
+                                                   max_passengers_per_cell=max_passengers_per_cell, vehicle_simulator=vehicle_simulator)
+        integrated_simulator = IntegratedSimulator(vehicle_simulator=vehicle_simulator, pedestrian_simulator=pedestrian_simulator)
+        return [integrated_simulator.run_simulation(*run_args, visualize=False, recording_policy=recording_policies[0])]
+    batch_simulator = BatchSimulator(
+        num_replicas=len(rngs), road_length=road_length, road_width=road_width, speed_limit=speed_limit, allowed_rows=params.allowed_rows_input,
+        sidewalk_length=road_length, sidewalk_width=sidewalk_width, max_passengers_per_cell=max_passengers_per_cell,
+        passenger_arrival_rate=passenger_arrival_rate, rngs=rngs)
+    return batch_simulator.run_simulation(*run_args, recording_policy=list(recording_policies))
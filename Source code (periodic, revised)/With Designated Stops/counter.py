@@ -1,3 +1,5 @@
+import numpy as np
+
 class Counter:
     def __init__(self):
         #self.position = position  # The position where we count vehicles
@@ -25,6 +27,13 @@ class Counter:
             if vehicle.vehicle_type == "truck":
                 self.total_trucks += 1
 
+    def count_in_bulk(self, crossed, occupied_seats, is_jeep):
+        """Same counts as the four methods above for many vehicles at once (boolean/integer arrays, one entry per vehicle)"""
+        self.total_vehicles += int(np.count_nonzero(crossed))
+        self.passenger_throughput += int(np.sum(occupied_seats[crossed]))
+        self.total_jeeps += int(np.count_nonzero(crossed & is_jeep))
+        self.total_trucks += int(np.count_nonzero(crossed & ~is_jeep))
+
     def calculate_vehicle_throughput(self):
         return self.total_vehicles
 
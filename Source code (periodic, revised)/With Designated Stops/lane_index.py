@@ -0,0 +1,84 @@
+from bisect import bisect_left
+
+
+class LaneRing:
+    """Vehicles whose right side is on one row, kept in cyclic order of rear bumper position.
+    Vehicles on the same row cannot overtake each other, so the order only changes when a vehicle enters or leaves the row.
+    Each member keeps leader/follower pointers to its neighbours on the ring."""
+
+    def __init__(self, road_length):
+        self.road_length = road_length
+        self.vehicles = []
+
+    def index_ahead(self, position):
+        """Index of the first vehicle whose rear bumper is at or ahead of position (binary search over the rotated, cyclically sorted ring)"""
+        base = self.vehicles[0].rear_bumper_position
+        index = bisect_left(self.vehicles, (position - base) % self.road_length, key=lambda vehicle: (vehicle.rear_bumper_position - base) % self.road_length)
+        return index % len(self.vehicles)
+
+    def insert(self, vehicle):
+        if self.vehicles:
+            index = self.index_ahead(vehicle.rear_bumper_position)
+            if index == 0: #Ahead of every rear bumper measured from the first vehicle, append at the end of the cycle
+                index = len(self.vehicles)
+            self.vehicles.insert(index, vehicle)
+        else:
+            index = 0
+            self.vehicles.append(vehicle)
+        vehicle.leader = self.vehicles[(index + 1) % len(self.vehicles)]
+        vehicle.follower = self.vehicles[index - 1]
+        vehicle.leader.follower = vehicle
+        vehicle.follower.leader = vehicle
+
+    def remove(self, vehicle):
+        self.vehicles.remove(vehicle)
+        vehicle.follower.leader = vehicle.leader
+        vehicle.leader.follower = vehicle.follower
+        vehicle.leader = vehicle.follower = None
+
+    def nearest_at_or_ahead(self, position):
+        """Distance from position to the first cell covered by a member at or ahead of it, and that member (None if the ring is empty)"""
+        if not self.vehicles:
+            return self.road_length, None
+        index = self.index_ahead(position)
+        behind = self.vehicles[index - 1]
+        if (position - behind.rear_bumper_position) % self.road_length < behind.length: #position is under the vehicle just behind it
+            return 0, behind
+        ahead = self.vehicles[index]
+        return (ahead.rear_bumper_position - position) % self.road_length, ahead
+
+
+class LaneIndex:
+    """One LaneRing per row a vehicle can be on (row 1 holds the straddling vehicles).
+    Answers gap queries from the vehicle positions alone, without reading the road occupancy grid."""
+
+    def __init__(self, road_length):
+        self.road_length = road_length
+        self.rings = {}
+
+    def update(self, vehicle):
+        """Moves the vehicle to the ring of its current row (nothing to do when it moved along its row)"""
+        if vehicle.lane_row == vehicle.current_row:
+            return
+        if vehicle.lane_row is not None:
+            self.rings[vehicle.lane_row].remove(vehicle)
+        if vehicle.current_row not in self.rings:
+            self.rings[vehicle.current_row] = LaneRing(self.road_length)
+        self.rings[vehicle.current_row].insert(vehicle)
+        vehicle.lane_row = vehicle.current_row
+
+    def distance_ahead(self, vehicle, row, width, position):
+        """Distance from position to the first cell ahead covered by another vehicle on rows row to row + width - 1.
+        The leader pointer answers it for the vehicle's own ring, the other overlapping rings are searched by bisection."""
+        distance = self.road_length
+        for ring_row, ring in self.rings.items():
+            if ring_row >= row + width or not ring.vehicles:
+                continue
+            if ring_row == vehicle.lane_row:
+                other = vehicle.leader
+                other_distance = (other.rear_bumper_position - position) % self.road_length if other is not vehicle else self.road_length
+            else:
+                other_distance, other = ring.nearest_at_or_ahead(position)
+            if ring_row + other.width > row:
+                distance = min(distance, other_distance)
+        return distance
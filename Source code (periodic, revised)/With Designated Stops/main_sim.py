@@ -1,17 +1,50 @@
 import pandas as pd
 import numpy as np
 from counter import Counter
+from vehicle_state import VEHICLE_TYPE_CODES, VehicleStateBatch
+import parallel_update
+from speed_stats import SpeedAccumulator
+from passenger_registry import PassengerState
+from recorders import GridRecorder, TrajectoryRecorder, StopQueueRecorder, PassengerRecordWriter, RecordingPolicy, RESULT_TABLES
 import matplotlib.pyplot as plt
 
+TIMESTEP_SUMMARY_COLUMNS = ["Timestep", "Actual Density", "Actual Truck Fraction", "Throughput", "Passenger Throughput", "Jeep Throughput", "Truck Throughput",
+                            "Jeep Spatial Mean Speed", "Truck Spatial Mean Speed", "Vehicle Spatial Mean Speed", "Truck Occupancy Fraction"]
+
 class IntegratedSimulator:
-    def __init__(self, vehicle_simulator, pedestrian_simulator):
+    def __init__(self, vehicle_simulator, pedestrian_simulator, update_mode="sequential", spatial_mean_speed="mixed", spatial_speed_window=None, recording_directory=None):
+        """update_mode is "sequential" (random sequential update of every vehicle) or "parallel" (vectorized synchronous update, needs the arrays vehicle state backend)
+        spatial_mean_speed chooses the spatial mean speeds of the timestep summary: "cumulative" (all samples since the start of the run),
+        "instantaneous" (samples of the current timestep), "windowed" (last spatial_speed_window timesteps) or
+        "mixed" (instantaneous for all vehicles, cumulative for jeeps and trucks, as in the earlier results)
+        recording_directory keeps the disk-backed spatio-temporal grids of the run there (temporary files otherwise)
+        The random numbers come from the np.random.Generator of the vehicle simulator"""
+        if update_mode not in ("sequential", "parallel"):
+            raise ValueError(f"Unknown update mode: {update_mode}")
+        if spatial_mean_speed not in ("mixed", "cumulative", "instantaneous", "windowed"):
+            raise ValueError(f"Unknown spatial mean speed: {spatial_mean_speed}")
+        if spatial_mean_speed == "windowed" and spatial_speed_window is None:
+            raise ValueError("The windowed spatial mean speed needs a spatial_speed_window")
+        if update_mode == "parallel" and vehicle_simulator.state is None:
+            raise ValueError("The parallel update mode needs IntraRoadSimulator(road, state_backend=\"arrays\")")
         self.vehicle_simulator = vehicle_simulator
+        self.rng = vehicle_simulator.rng
+        self.update_mode = update_mode
         self.pedestrian_simulator = pedestrian_simulator
         self.counter = Counter()
         self.current_time = 0
-        self.jeep_spatial_speeds = []
-        self.truck_spatial_speeds = []
-        self.vehicle_spatial_speeds = []
+        self.spatial_mean_speed = spatial_mean_speed
+        self.recording_directory = recording_directory
+        self.recording_policy = RecordingPolicy() #Recording policy of the current run, set by start_run
+        self.grid_recorder = None #GridRecorder of the current run, created by start_run when the grids are recorded
+        self.trajectory_recorder = None #TrajectoryRecorder of the current run, created by start_run when the trajectories are recorded
+        self.recorded_vehicles = None #Vehicles in the column order of the trajectory recorder
+        self.recorded_slots = None #Their state slots, in the parallel update mode
+        self.stop_queue_recorder = None #StopQueueRecorder of the current run, created by start_run when the stop queues are recorded
+        self.passenger_record_writer = None #PassengerRecordWriter of the alighted passengers, when the recording policy streams them
+        self.jeep_spatial_speeds = SpeedAccumulator(spatial_speed_window) #Speeds of every vehicle at every recorded timestep, as running sums
+        self.truck_spatial_speeds = SpeedAccumulator(spatial_speed_window)
+        self.vehicle_spatial_speeds = SpeedAccumulator(spatial_speed_window)
         self.throughput = 0
         self.passenger_throughput = 0
         self.jeep_throughput = 0
@@ -23,11 +56,11 @@ class IntegratedSimulator:
 
     def populate_the_road(self,  adjacent_sidewalk, timestep, transient_time, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows):
         "This method makes sure all vehicles are spawned on the road"
-        if (self.vehicle_simulator.spawned_vehicles < self.vehicle_simulator.total_vehicles) and (self.vehicle_simulator.unsuccessful_vehicle_placement_tries < (self.vehicle_simulator.total_vehicles*2)): #(self.vehicle_simulator.road.length/3)): #Feb 19 2025: The 2nd condition is too strict. #If not all vehicles have been spawned yet
+        if self.road_is_being_populated(): #If not all vehicles have been spawned yet
             #Alternate between spawning trucks and jeeps
             truck_length, jeep_length = 7, 3
             truck_width, jeep_width = 2, 2            
-            if np.random.rand() < 0.5: #Equal chances of both vehicle types to be placed
+            if self.rng.random() < 0.5: #Equal chances of both vehicle types to be placed
                 if (self.vehicle_simulator.spawned_trucks < self.vehicle_simulator.total_trucks):
                     # for x_position in range(self.road.road_length):
                     self.vehicle_simulator.place_vehicles('truck', truck_length, truck_width, adjacent_sidewalk, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows)
@@ -39,68 +72,165 @@ class IntegratedSimulator:
 
             for vehicle in self.vehicle_simulator.vehicles:
                 vehicle.speed = 0
+            self.vehicle_simulator.store_state()
         else: #self.vehicle_simulator.unsuccessful_vehicle_placement_tries > (self.vehicle_simulator.total_vehicles * 2): # After certain number of tries, the vehicle cannot be placed and we stopped populating the road
             self.integrated_simulation_step(timestep, transient_time)
         #else:
             #self.integrated_simulation_ste, #Commented out: February 19, 2025 (3:02 PM)
 
     def integrated_simulation_step(self, timestep, transient_time): #Integrated Simulation Step
-        np.random.shuffle(self.vehicle_simulator.vehicles)
-        np.random.shuffle(self.pedestrian_simulator.passengers)
-        self.vehicle_spatial_speeds = []
+        if self.update_mode == "parallel":
+            self.parallel_simulation_step(timestep, transient_time)
+            return
+        vehicles_in_update_order = self.vehicle_simulator.shuffle_update_order() #Passengers have no update order of their own, they are driven by the vehicles
+        self.start_spatial_speed_step()
         if len(self.vehicle_simulator.vehicles) > 0:
-            for vehicle in self.vehicle_simulator.vehicles:
-                if vehicle.current_row == 1: # We  dont have to check for speed because vehicles cannot straddle if their v = 0
-                    vehicle.finish_lane_change()
-                    self.inform_driver_of_destination(vehicle)
-
-                elif np.random.rand() < vehicle.lane_changing_prob:
-                    vehicle.accelerate()
-                    vehicle.lane_changing()
-                    vehicle.decelerate()
-                    if vehicle.vehicle_type == "jeep":
-                        vehicle.unloading(timestep)
-                        vehicle.loading(timestep)
-                    vehicle.random_slowdown()
-                    vehicle.move() #Move the vehicle
-                    self.inform_driver_of_destination(vehicle)
-            
-                else:
-                    vehicle.accelerate() 
-                    vehicle.decelerate() 
-                    if vehicle.vehicle_type == "jeep":
-                        vehicle.unloading(timestep)
-                        vehicle.loading(timestep)
-                    vehicle.random_slowdown()
-                    vehicle.move()
-                    self.inform_driver_of_destination(vehicle)
-                for passenger in vehicle.passengers_within_vehicle:
-                    passenger.determine_if_overshot_destination(vehicle)   
-                if timestep >= transient_time:     
-                    vehicle.temporal_speeds.append(vehicle.speed)
-                self.pedestrian_simulator.update_occupancy(timestep)
-                self.vehicle_simulator.update_occupancy(timestep)
-
-                self.counter.count_vehicle(vehicle)
-                self.counter.count_passenger(vehicle)
-                self.counter.count_jeeps(vehicle)
-                self.counter.count_trucks(vehicle)
-
-            self.vehicle_simulator.occupancy_history.append((timestep, self.vehicle_simulator.road.occupancy.copy()))
-            self.pedestrian_simulator.sidewalk_occupancy_history.append((timestep, self.pedestrian_simulator.sidewalk.occupancy.copy()))
+            for vehicle in vehicles_in_update_order:
+                lane_change_roll = self.rng.random() if vehicle.current_row != 1 else None #Straddling vehicles do not roll for lane changing
+                self.update_vehicle(vehicle, timestep, transient_time, lane_change_roll)
+                #Road and sidewalk occupancies are updated incrementally by Vehicle.move() and Passenger.board_vehicle()
 
-            for vehicle in self.vehicle_simulator.vehicles:
-                self.vehicle_spatial_speeds.append(vehicle.speed) #include the vehicle's speed on the list of all the vehicle's speed
-                if vehicle.vehicle_type == "jeep":
-                    self.jeep_spatial_speeds.append(vehicle.speed)
-                else:
-                    self.truck_spatial_speeds.append(vehicle.speed)
+            self.record_step(timestep)
 
         for stop in self.pedestrian_simulator.sidewalk.stops:
             if stop:
                 stop_interest = stop[0]
                 #print(f"For Stop at {stop_interest.position}, the loading list is {stop_interest.loading_list} with {len(stop_interest.loading_list)} elements.")
                 pass
+
+    def update_vehicle(self, vehicle, timestep, transient_time, lane_change_roll):
+        """Random sequential update of a single vehicle (lane changing, passenger interactions and movement)"""
+        if vehicle.current_row == 1: # We  dont have to check for speed because vehicles cannot straddle if their v = 0
+            vehicle.finish_lane_change()
+            self.inform_driver_of_destination(vehicle)
+
+        elif lane_change_roll < vehicle.lane_changing_prob:
+            vehicle.accelerate()
+            vehicle.lane_changing()
+            vehicle.decelerate()
+            if vehicle.vehicle_type == "jeep":
+                vehicle.unloading(timestep)
+                vehicle.loading(timestep)
+            vehicle.random_slowdown()
+            vehicle.move() #Move the vehicle
+            self.inform_driver_of_destination(vehicle)
+    
+        else:
+            vehicle.accelerate() 
+            vehicle.decelerate() 
+            if vehicle.vehicle_type == "jeep":
+                vehicle.unloading(timestep)
+                vehicle.loading(timestep)
+            vehicle.random_slowdown()
+            vehicle.move()
+            self.inform_driver_of_destination(vehicle)
+        for passenger in vehicle.passengers_within_vehicle:
+            passenger.determine_if_overshot_destination(vehicle)   
+        if timestep >= transient_time:     
+            vehicle.temporal_speed_stats.add(vehicle.speed)
+
+        self.counter.count_vehicle(vehicle)
+        self.counter.count_passenger(vehicle)
+        self.counter.count_jeeps(vehicle)
+        self.counter.count_trucks(vehicle)
+
+    def parallel_simulation_step(self, timestep, transient_time):
+        """Synchronous (NaSch-style) update: vehicles that change lanes, straddle, or interact with passengers are updated one by one first,
+        then every other vehicle is accelerated, decelerated, slowed down and moved in one vectorized pass"""
+        state = self.vehicle_simulator.state
+        fallback_order, lane_change_rolls = self.begin_parallel_step()
+        if state.count > 0:
+            slots = np.arange(state.count)
+            needs_sequential_update = parallel_update.needs_sequential_update(
+                self.vehicle_simulator.road.occupancy[None], self.pedestrian_simulator.sidewalk.occupancy[None],
+                VehicleStateBatch.view_of(state), np.zeros(state.count, dtype=np.int64), slots, lane_change_rolls)
+            self.update_sequential_vehicles(timestep, transient_time, fallback_order, lane_change_rolls, needs_sequential_update)
+            bulk_slots = np.flatnonzero(~needs_sequential_update)
+            self.vehicle_simulator.parallel_update(bulk_slots)
+            self.finish_parallel_step(timestep, transient_time, bulk_slots)
+
+    def begin_parallel_step(self):
+        """Draws the random numbers of a parallel step: update order of the fallback vehicles and lane change rolls"""
+        fallback_order = self.vehicle_simulator.state.shuffle_order(self.rng)
+        self.start_spatial_speed_step()
+        lane_change_rolls = self.rng.random(self.vehicle_simulator.state.count)
+        return fallback_order, lane_change_rolls
+
+    def update_sequential_vehicles(self, timestep, transient_time, fallback_order, lane_change_rolls, needs_sequential_update):
+        """Applies the per-vehicle rules, in random sequential order, to the vehicles the vectorized update cannot handle,
+        then copies their new state into the state arrays"""
+        for slot in fallback_order:
+            if needs_sequential_update[slot]:
+                vehicle = self.vehicle_simulator.vehicles[slot]
+                lane_change_roll = lane_change_rolls[slot] if vehicle.current_row != 1 else None
+                self.vehicle_simulator.catch_up(vehicle)
+                self.update_vehicle(vehicle, timestep, transient_time, lane_change_roll)
+        self.vehicle_simulator.store_state(np.flatnonzero(needs_sequential_update))
+
+    def finish_parallel_step(self, timestep, transient_time, bulk_slots):
+        """Speed and throughput bookkeeping of the vehicles moved by the vectorized update, then records the step"""
+        state = self.vehicle_simulator.state
+        if timestep >= transient_time:
+            self.vehicle_simulator.add_bulk_speeds(bulk_slots)
+        crossed = state.rear_bumper_position[bulk_slots] < state.previous_rear_bumper_position[bulk_slots]
+        is_jeep = state.vehicle_type[bulk_slots] == VEHICLE_TYPE_CODES["jeep"]
+        self.counter.count_in_bulk(crossed, state.occupied_seats[bulk_slots], is_jeep)
+        self.record_step(timestep)
+
+    def record_step(self, timestep):
+        """Stores the occupancy grids (when the recording policy asks for them) and the spatial speeds after all vehicles were updated"""
+        if self.recording_policy.records_step(timestep, self.max_timesteps, self.transient_time):
+            if self.grid_recorder is not None:
+                self.grid_recorder.record(timestep, self.vehicle_simulator.road.occupancy, self.pedestrian_simulator.sidewalk.occupancy)
+            if self.trajectory_recorder is not None:
+                self.record_trajectories(timestep)
+            if self.stop_queue_recorder is not None:
+                pedestrian_simulator = self.pedestrian_simulator
+                self.stop_queue_recorder.record(timestep, pedestrian_simulator.sidewalk.occupancy, pedestrian_simulator.boarded_at, pedestrian_simulator.alighted_at)
+
+        state = self.vehicle_simulator.state
+        if self.update_mode == "parallel": #Read the speeds straight from the state arrays, kept in sync by the parallel step
+            speeds = state.active("speed")
+            is_jeep = state.active("vehicle_type") == VEHICLE_TYPE_CODES["jeep"]
+        else:
+            speeds = np.array([vehicle.speed for vehicle in self.vehicle_simulator.vehicles], dtype=np.int64)
+            is_jeep = np.array([vehicle.vehicle_type == "jeep" for vehicle in self.vehicle_simulator.vehicles], dtype=bool)
+        self.vehicle_spatial_speeds.add(speeds)
+        self.jeep_spatial_speeds.add(speeds[is_jeep])
+        self.truck_spatial_speeds.add(speeds[~is_jeep])
+
+    def record_trajectories(self, timestep):
+        """Stores the position, row and speed of every vehicle, in vehicle ID order"""
+        state = self.vehicle_simulator.state
+        if self.recorded_vehicles is None: #The road is populated, the vehicles no longer change
+            self.recorded_vehicles = sorted(self.vehicle_simulator.vehicles, key=lambda vehicle: vehicle.vehicle_id)
+            vehicles = self.recorded_vehicles
+            self.trajectory_recorder.set_vehicles([vehicle.vehicle_id for vehicle in vehicles], [VEHICLE_TYPE_CODES[vehicle.vehicle_type] for vehicle in vehicles],
+                                                  [vehicle.length for vehicle in vehicles], [vehicle.width for vehicle in vehicles])
+            self.recorded_slots = np.array([vehicle.slot for vehicle in vehicles], dtype=np.int64) if self.update_mode == "parallel" else None
+        if self.update_mode == "parallel":
+            slots = self.recorded_slots
+            self.trajectory_recorder.record(timestep, state.rear_bumper_position[slots], state.current_row[slots], state.speed[slots])
+        else:
+            vehicles = self.recorded_vehicles
+            self.trajectory_recorder.record(timestep, [vehicle.rear_bumper_position for vehicle in vehicles], [vehicle.current_row for vehicle in vehicles],
+                                            [vehicle.speed for vehicle in vehicles])
+
+    def start_spatial_speed_step(self):
+        for accumulator in (self.vehicle_spatial_speeds, self.jeep_spatial_speeds, self.truck_spatial_speeds):
+            accumulator.start_step()
+
+    def spatial_mean_speeds(self):
+        """(vehicle, jeep, truck) spatial mean speeds of the timestep summary, according to the spatial_mean_speed setting"""
+        accumulators = (self.vehicle_spatial_speeds, self.jeep_spatial_speeds, self.truck_spatial_speeds)
+        if self.spatial_mean_speed == "cumulative":
+            return tuple(accumulator.mean() for accumulator in accumulators)
+        if self.spatial_mean_speed == "instantaneous":
+            return tuple(accumulator.step_mean() for accumulator in accumulators)
+        if self.spatial_mean_speed == "windowed":
+            return tuple(accumulator.window_mean() for accumulator in accumulators)
+        return self.vehicle_spatial_speeds.step_mean(), self.jeep_spatial_speeds.mean(), self.truck_spatial_speeds.mean()
+
     #Compute riding times once, not everytime step. Just compute it at the end.
 
     def inform_driver_of_destination(self, vehicle):
@@ -116,6 +246,17 @@ class IntegratedSimulator:
                 #print(f"Passenger {passenger.passenger_id} informed the driver that his destination is at {passenger.destination_stop}.")
         return
 
+    def merge_alighted_passenger_records(self, data_passengers):
+        """Adds the records of the streamed alighted passengers to the passenger columns, in spawn (passenger ID) order"""
+        records = self.passenger_record_writer.records()
+        self.passenger_record_writer.close()
+        merged = {}
+        for column, values in data_passengers.items():
+            streamed = np.full(len(records), PassengerState.ALIGHTED.value).tolist() if column == "Riding Status" else records[column].tolist()
+            merged[column] = streamed + values
+        order = np.argsort(merged["Passenger ID"], kind="stable")
+        return {column: [values[index] for index in order] for column, values in merged.items()}
+
     def calculate_riding_time(self, timestep):
         for passenger in self.pedestrian_simulator.in_transit_passengers:
             passenger.riding_time = timestep - passenger.jeep_boarding_time
@@ -133,170 +274,159 @@ class IntegratedSimulator:
         return
 
 
-    def run_simulation(self, max_timesteps,  transient_time, density, truck_fraction, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows, visualize=False):
+    def run_simulation(self, max_timesteps,  transient_time, density, truck_fraction, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows, visualize=False, recording_policy=None):
+        """Runs a whole simulation and returns its result tables (see RecordingPolicy for what is recorded, everything by default)"""
         timestep = 0
-        # Initialize or reset relevant data
-        self.vehicle_simulator.initialize_vehicles(density, truck_fraction)
-        
-        data_vehicles = []
-        data_timestep = []
-        data_passengers = []
-        data_jeep = []
-        data_trucks = []
-        data_spatio_temporal = None
-        data_sidewalk_spatio_temporal = None
-        #data_temporal_speeds = []
-
-        self.pedestrian_simulator.generate_stops(stop_to_stop_distance)
-        #print(f"The stops generated")
+        self.start_run(density, truck_fraction, stop_to_stop_distance, max_timesteps, transient_time, recording_policy)
         while timestep < max_timesteps:
             # Update both simulators at each timestep
-            if timestep < transient_time:
-                #print(f"Implementing rules for timestep {timestep}")
-                self.current_time = timestep
-                self.pedestrian_simulator.current_time = timestep
-                self.vehicle_simulator.current_time = timestep
-                
-                self.pedestrian_simulator.generate_passengers(self.vehicle_simulator, timestep)
-                self.populate_the_road( self.pedestrian_simulator.sidewalk, timestep, transient_time, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows)  # Update vehicles
-                for passenger in self.pedestrian_simulator.passengers:
-                    passenger.current_time = timestep
-
-            # Collect data after transient period
-            else: #timestep >= transient_time:
-                #print(f"Implementing rules for timestep {timestep}")
-                self.current_time = timestep
-                self.pedestrian_simulator.current_time = timestep
-                self.vehicle_simulator.current_time = timestep
-
-                self.pedestrian_simulator.generate_passengers(self.vehicle_simulator, timestep)
-                self.populate_the_road(  self.pedestrian_simulator.sidewalk,timestep, transient_time, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows) # Update vehicles
-                for passenger in self.pedestrian_simulator.passengers:
-                    passenger.current_time = timestep
-                
-                #Collect data for Travel speed of each vehicle
-                if timestep == transient_time:
-                    for vehicle in self.vehicle_simulator.vehicles:
-                        self.starting_rear_bumper_position = vehicle.rear_bumper_position
-                elif timestep == max_timesteps - 1:
-                    for vehicle in self.vehicle_simulator.vehicles:
-                        self.end_rear_bumper_position = vehicle.rear_bumper_position
-
-            #Collect data for each timestep (even at transient, just discard at data processing)
-            self.throughput = self.counter.calculate_vehicle_throughput()
-            self.passenger_throughput = self.counter.calculate_passenger_throughput()
-            self.jeep_throughput = self.counter.calculate_jeep_throughput()
-            self.truck_throughput = self.counter.calculate_truck_throughput()
-            self.actual_density = (self.vehicle_simulator.spawned_vehicles_occupancy) / (self.vehicle_simulator.road.length * self.vehicle_simulator.road.width)
-            self.actual_truck_fraction = (self.vehicle_simulator.spawned_trucks / self.vehicle_simulator.spawned_vehicles) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
-            self.actual_truck_occupancy_fraction = (self.vehicle_simulator.spawned_trucks*14)/ ((self.vehicle_simulator.spawned_trucks*14)+(self.vehicle_simulator.spawned_jeeps*6)) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
-            vehicle_spatial_mean_speed = np.mean(self.vehicle_spatial_speeds) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
-            jeep_spatial_mean_speed = np.mean(self.jeep_spatial_speeds) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
-            truck_spatial_mean_speed = np.mean(self.truck_spatial_speeds) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
-                
-            data_timestep.append({
-                "Timestep": timestep,
-                "Actual Density": self.actual_density,
-                "Actual Truck Fraction": self.actual_truck_fraction,
-                "Throughput": self.throughput,
-                "Passenger Throughput":self.passenger_throughput,
-                "Jeep Throughput":self.jeep_throughput,
-                "Truck Throughput":self.truck_throughput,
-                "Jeep Spatial Mean Speed":jeep_spatial_mean_speed,
-                "Truck Spatial Mean Speed":truck_spatial_mean_speed,
-                "Vehicle Spatial Mean Speed":vehicle_spatial_mean_speed,
-                "Truck Occupancy Fraction":self.actual_truck_occupancy_fraction})
+            self.begin_timestep(timestep)
+            self.populate_the_road(self.pedestrian_simulator.sidewalk, timestep, transient_time, stop_to_stop_distance, safe_stopping_speed, safe_deceleration, jeepney_allowed_rows, truck_allowed_rows) # Update vehicles
+            self.end_timestep(timestep, max_timesteps, transient_time)
             if visualize:
                 #self.visualize(timestep)
                 self.visualize_combined(timestep)
             
             timestep += 1
-        
-        self.calculate_riding_time(timestep)
-        self.calculate_waiting_time(timestep)
+        return self.collect_results(timestep)
 
-        #Collect spatio-temporal data of the road
-        occupancy_data = []
-        for timestep, occupancy_grid in self.vehicle_simulator.occupancy_history:
-            # print(f"The number of rows on the road based on occupancy grid is {occupancy_grid.shape[1]}")
-            for y in range(occupancy_grid.shape[1]):  # Loop over each row (y-axis)
-                occupancy_data.append([timestep, y] + occupancy_grid[:, y].tolist())  # Store row-wise data
-        road_length = self.vehicle_simulator.road.length
-        columns = ["Timestep", "Road Row"] + [f"Pos {x}" for x in range(road_length)]
-        data_spatio_temporal = pd.DataFrame(occupancy_data, columns=columns) #Create DataFrame
-
-
-        #Collect spatio-temporal data of the sidewalk
-        sidewalk_occupancy_data = []
-        for timestep, occupancy_row in self.pedestrian_simulator.sidewalk_occupancy_history:
-            sidewalk_occupancy_data.append([timestep] + occupancy_row.tolist())  # Directly store row data
-
-        sidewalk_length = self.pedestrian_simulator.sidewalk.length
-        sidewalk_columns = ["Timestep"]+[f"Pos {x}" for x in range(sidewalk_length)]  #Create DataFrame
-        data_sidewalk_spatio_temporal = pd.DataFrame(sidewalk_occupancy_data, columns=sidewalk_columns)
-
-
-        # Collect passenger data(after running the whole simulation)
-        for passenger in self.pedestrian_simulator.passengers:
-            # if (passenger.jeep_boarding_time > transient_time and passenger.arrived_at_destination_time > transient_time):
-            riding_time = passenger.riding_time
-            waiting_time = passenger.waiting_time
-            spawning_time = passenger.sidewalk_entry_time
-            boarding_time = passenger.jeep_boarding_time
-            alighting_time = passenger.arrived_at_destination_time
-            if passenger in self.pedestrian_simulator.waiting_passengers:
-                status = "Waiting"
-            elif passenger in self.pedestrian_simulator.in_transit_passengers:
-                status = "In-Transit"
-            elif passenger in self.pedestrian_simulator.alighted_passengers:
-                status = "Alighted"
-            else:
-                status = "Unknown"  # Fallback case, should not normally happen
-
-            data_passengers.append({
-                "Passenger ID": passenger.passenger_id,
-                "Riding Time": riding_time,
-                "Waiting Time": waiting_time,
-                "Riding Status":status,
-                "Spawning Time": spawning_time,
-                "Boarding Time": boarding_time,
-                "Alighting Time": alighting_time})
-                #"Passenger Travel Speed":passenger_travel_speed})
-        #max_speed_timesteps = max([len(vehicle.temporal_speeds) for vehicle in self.vehicle_simulator.vehicles])
-        #Collect vehicle data
-        for vehicle in self.vehicle_simulator.vehicles:
-            vehicle.mean_temporal_speed = np.mean(vehicle.temporal_speeds)
+    def start_run(self, density, truck_fraction, stop_to_stop_distance, max_timesteps, transient_time, recording_policy=None):
+        """Initializes or resets the data of a run and generates the stops"""
+        self.vehicle_simulator.next_vehicle_id = 0 #Vehicle and passenger IDs count from 0 in every run
+        self.pedestrian_simulator.next_passenger_id = 0
+        self.vehicle_simulator.initialize_vehicles(density, truck_fraction)
+        self.data_timestep = []
+        self.pedestrian_simulator.generate_stops(stop_to_stop_distance)
+        self.max_timesteps = max_timesteps
+        self.transient_time = transient_time
+        self.recording_policy = recording_policy if recording_policy is not None else RecordingPolicy()
+        recorded_steps = self.recording_policy.steps_to_record(max_timesteps, transient_time)
+        if self.recording_policy.records("SpatioTemporal") or self.recording_policy.records("SidewalkPatioTemporal"):
+            self.grid_recorder = GridRecorder(recorded_steps, self.vehicle_simulator.road.occupancy.shape, self.pedestrian_simulator.sidewalk.occupancy.shape, self.recording_directory)
+        else:
+            self.grid_recorder = None
+        if self.recording_policy.records("VehicleTrajectories"):
+            self.trajectory_recorder = TrajectoryRecorder(recorded_steps, self.recording_policy.trajectory_changes_only)
+        else:
+            self.trajectory_recorder = None
+        self.recorded_vehicles = None
+        if self.recording_policy.records("StopQueues"):
+            self.stop_queue_recorder = StopQueueRecorder(recorded_steps, self.pedestrian_simulator.stop_positions, self.recording_policy.stop_events)
+        else:
+            self.stop_queue_recorder = None
+        if self.recording_policy.records("PassengerData") and self.recording_policy.passenger_batch_size is not None:
+            self.passenger_record_writer = PassengerRecordWriter(self.recording_policy.passenger_batch_size, self.recording_directory)
+            self.pedestrian_simulator.registry.stream_alighted(self.passenger_record_writer)
+        else:
+            self.passenger_record_writer = None
+        #print(f"The stops generated")
 
-            data_vehicles.append({"Vehicle ID":vehicle.vehicle_id, "Vehicle Type":vehicle.vehicle_type,
-                                        "Mean Speed Across Time":vehicle.mean_temporal_speed,
-                                        "Actual Density":self.actual_density, 
-                                        "Truck Occupancy Fraction":self.actual_truck_occupancy_fraction})
+    def begin_timestep(self, timestep):
+        """Advances the clocks and spawns the passengers of a timestep (before the vehicles are updated)"""
+        self.current_time = timestep
+        self.pedestrian_simulator.current_time = timestep
+        self.vehicle_simulator.current_time = timestep
+        self.pedestrian_simulator.generate_passengers(self.vehicle_simulator, timestep)
+
+    def end_timestep(self, timestep, max_timesteps, transient_time):
+        """Collects the data of a timestep (after the vehicles are updated)"""
+        for passenger in self.pedestrian_simulator.registry.active(): #Alighted passengers no longer change
+            passenger.current_time = timestep
+
+        # Collect data after transient period
+        if timestep >= transient_time:
+            #Collect data for Travel speed of each vehicle
+            if timestep == transient_time:
+                for vehicle in self.vehicle_simulator.vehicles:
+                    self.starting_rear_bumper_position = vehicle.rear_bumper_position
+            elif timestep == max_timesteps - 1:
+                for vehicle in self.vehicle_simulator.vehicles:
+                    self.end_rear_bumper_position = vehicle.rear_bumper_position
+
+        #Collect data for each timestep (even at transient, just discard at data processing)
+        self.throughput = self.counter.calculate_vehicle_throughput()
+        self.passenger_throughput = self.counter.calculate_passenger_throughput()
+        self.jeep_throughput = self.counter.calculate_jeep_throughput()
+        self.truck_throughput = self.counter.calculate_truck_throughput()
+        self.actual_density = (self.vehicle_simulator.spawned_vehicles_occupancy) / (self.vehicle_simulator.road.length * self.vehicle_simulator.road.width)
+        self.actual_truck_fraction = (self.vehicle_simulator.spawned_trucks / self.vehicle_simulator.spawned_vehicles) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
+        self.actual_truck_occupancy_fraction = (self.vehicle_simulator.spawned_trucks*14)/ ((self.vehicle_simulator.spawned_trucks*14)+(self.vehicle_simulator.spawned_jeeps*6)) if (self.vehicle_simulator.spawned_vehicles > 0) else 0
+        if not (self.recording_policy.records("TimestepSummary") and self.recording_policy.records_step(timestep, max_timesteps, transient_time)):
+            return
+        if self.vehicle_simulator.spawned_vehicles > 0:
+            vehicle_spatial_mean_speed, jeep_spatial_mean_speed, truck_spatial_mean_speed = self.spatial_mean_speeds()
+        else:
+            vehicle_spatial_mean_speed, jeep_spatial_mean_speed, truck_spatial_mean_speed = 0, 0, 0
+            
+        self.data_timestep.append((timestep, self.actual_density, self.actual_truck_fraction, self.throughput, self.passenger_throughput,
+                                   self.jeep_throughput, self.truck_throughput, jeep_spatial_mean_speed, truck_spatial_mean_speed,
+                                   vehicle_spatial_mean_speed, self.actual_truck_occupancy_fraction)) #One row per timestep, see TIMESTEP_SUMMARY_COLUMNS
 
-            if vehicle.vehicle_type == "jeep":
-                data_jeep.append({"Jeep ID":vehicle.vehicle_id,
-                                        "Mean Speed Across Time":vehicle.mean_temporal_speed,
-                                        "Actual Density":self.actual_density, 
-                                        "Truck Occupancy Fraction":self.actual_truck_occupancy_fraction})
-            else:
-                data_trucks.append({"Truck ID":vehicle.vehicle_id,
-                                        "Mean Speed Across Time":vehicle.mean_temporal_speed,
-                                        "Actual Density":self.actual_density, 
-                                        "Truck Occupancy Fraction":self.actual_truck_occupancy_fraction})
+    def road_is_being_populated(self):
+        """True while populate_the_road still spawns vehicles instead of updating them"""
+        vehicle_simulator = self.vehicle_simulator
+        return (vehicle_simulator.spawned_vehicles < vehicle_simulator.total_vehicles) and (vehicle_simulator.unsuccessful_vehicle_placement_tries < (vehicle_simulator.total_vehicles*2))
 
-            #For temporal speeds csv file
-            # row = {"Vehicle ID": vehicle.vehicle_id,"Vehicle Type": vehicle.vehicle_type}
-            # for t in range(max_speed_timesteps):
-            #     row[f"Timestep {t}"] = vehicle.temporal_speeds[t] if t < len(vehicle.temporal_speeds) else None
-            # data_temporal_speeds.append(row)
+    def collect_results(self, timestep):
+        """Builds the result tables of a run that stopped at the given timestep"""
+        data_spatio_temporal = None
+        data_sidewalk_spatio_temporal = None
+        data_trajectories = None
+        data_stop_queues = None
+
+        self.calculate_riding_time(timestep)
+        self.calculate_waiting_time(timestep)
+
+        policy = self.recording_policy
+
+        #Collect spatio-temporal data of the road and the sidewalk
+        if self.grid_recorder is not None:
+            self.grid_recorder.flush()
+            data_spatio_temporal = self.grid_recorder.road_table() if policy.records("SpatioTemporal") else None
+            data_sidewalk_spatio_temporal = self.grid_recorder.sidewalk_table() if policy.records("SidewalkPatioTemporal") else None
+        if self.trajectory_recorder is not None:
+            data_trajectories = self.trajectory_recorder.table()
+        if self.stop_queue_recorder is not None:
+            data_stop_queues = self.stop_queue_recorder.table()
+
+
+        # Collect passenger data(after running the whole simulation), one column at a time
+        if self.passenger_record_writer is not None: #Alighted passengers were streamed out, only the active ones are left
+            passengers = sorted(self.pedestrian_simulator.registry.active(), key=lambda passenger: passenger.passenger_id)
+        else:
+            passengers = self.pedestrian_simulator.passengers if policy.records("PassengerData") else []
+        data_passengers = {
+            "Passenger ID": [passenger.passenger_id for passenger in passengers],
+            "Riding Time": [passenger.riding_time for passenger in passengers],
+            "Waiting Time": [passenger.waiting_time for passenger in passengers],
+            "Riding Status": [passenger.state.value if passenger.state is not None else "Unknown" for passenger in passengers], # Fallback case, should not normally happen
+            "Spawning Time": [passenger.sidewalk_entry_time for passenger in passengers],
+            "Boarding Time": [passenger.jeep_boarding_time for passenger in passengers],
+            "Alighting Time": [passenger.arrived_at_destination_time for passenger in passengers]}
+        if self.passenger_record_writer is not None:
+            data_passengers = self.merge_alighted_passenger_records(data_passengers)
+
+        #Collect vehicle data
+        self.vehicle_simulator.settle_bulk_vehicles()
+        vehicles = self.vehicle_simulator.vehicles_in_update_order() if policy.records("VehicleData") else []
+        for vehicle in vehicles:
+            vehicle.mean_temporal_speed = vehicle.temporal_speed_stats.mean()
+        data_vehicles = {
+            "Vehicle ID": [vehicle.vehicle_id for vehicle in vehicles],
+            "Vehicle Type": [vehicle.vehicle_type for vehicle in vehicles],
+            "Mean Speed Across Time": [vehicle.mean_temporal_speed for vehicle in vehicles],
+            "Actual Density": np.full(len(vehicles), self.actual_density),
+            "Truck Occupancy Fraction": np.full(len(vehicles), self.actual_truck_occupancy_fraction)}
 
         # Return the results in a dataframe
-        results_timestep = pd.DataFrame(data_timestep)
+        results_timestep = pd.DataFrame(self.data_timestep, columns=TIMESTEP_SUMMARY_COLUMNS)
         results_vehicles = pd.DataFrame(data_vehicles)
         results_passengers = pd.DataFrame(data_passengers)
         results_spatio_temporal = pd.DataFrame(data_spatio_temporal)
         results_sidewalk_spatio_temporal = pd.DataFrame(data_sidewalk_spatio_temporal)
         #results_temporal_speeds = pd.DataFrame(data_temporal_speeds)
-        return results_timestep, results_passengers, results_vehicles, results_spatio_temporal, results_sidewalk_spatio_temporal#, results_temporal_speeds
+        results = (results_timestep, results_passengers, results_vehicles, results_spatio_temporal, results_sidewalk_spatio_temporal, data_trajectories, data_stop_queues)#, results_temporal_speeds
+        return tuple(table if policy.records(name) else None for name, table in zip(RESULT_TABLES, results)) #Tables that are not recorded are None
 
     def visualize(self, timestep):
         """Visualize both the vehicle and pedestrian data at a specific timestep."""
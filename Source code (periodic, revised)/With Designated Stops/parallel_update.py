@@ -0,0 +1,105 @@
+import numpy as np
+
+from vehicle_state import VEHICLE_TYPE_CODES
+
+# Vectorized (NaSch-style) update rules shared by the single-trial parallel mode and the multi-replica batch.
+# Every array carries a leading replica dimension: road occupancy is (replicas x road length x road width),
+# sidewalk occupancy is (replicas x sidewalk length x sidewalk width) and the vehicle state is a VehicleStateBatch
+# (replicas x vehicle slots). Vehicles are addressed by matching (replicas, slots) index arrays.
+
+
+def distance_to_next_occupied(occupied_cells, replicas, positions):
+    """Cyclic distance from each position to the first occupied cell at or ahead of it on the road of its replica (road length if that road is empty).
+    occupied_cells is a boolean (replicas x road length) array, replicas and positions are integer arrays of the same size."""
+    road_length = occupied_cells.shape[1]
+    occupied = np.flatnonzero(occupied_cells) #Sorted, encoded as replica * road length + position
+    replica_starts = np.searchsorted(occupied, np.arange(occupied_cells.shape[0]) * road_length)
+    replica_ends = np.append(replica_starts[1:], occupied.size)
+    queries = replicas * road_length + positions
+    next_index = np.searchsorted(occupied, queries)
+    wrapped = next_index >= replica_ends[replicas] #Nothing ahead before the end of the road, continue from its start
+    next_index[wrapped] = replica_starts[replicas][wrapped]
+    found = replica_starts[replicas] < replica_ends[replicas]
+    distances = np.full(len(positions), road_length)
+    distances[found] = (occupied[next_index[found]] - queries[found]) % road_length
+    return distances
+
+
+def gaps_ahead(road_occupancy, state, replicas, slots):
+    """Number of free cells in front of each vehicle on its own lane (Vehicle.gap_distance without the look-ahead cap),
+    found with one sorted search over every lane instead of a cell-by-cell scan"""
+    if len(slots) == 0:
+        return np.zeros(0, dtype=np.int64)
+    road_length, road_width = road_occupancy.shape[1], road_occupancy.shape[2]
+    rows = state.current_row[replicas, slots]
+    widths = state.width[replicas, slots]
+    first_cells_ahead = (state.rear_bumper_position[replicas, slots] + state.length[replicas, slots]) % road_length
+    lane_keys, lanes = np.unique(rows * (road_width + 1) + widths, return_inverse=True)
+    #Occupancy of every (replica, lane) pair stacked as the rows of one grid, so a single sorted search serves every lane
+    lane_occupied = np.stack([road_occupancy[:, :, row:row + width].any(axis=2) for row, width in zip(*np.divmod(lane_keys, road_width + 1))], axis=1)
+    return distance_to_next_occupied(lane_occupied.reshape(-1, road_length), replicas * len(lane_keys) + lanes, first_cells_ahead)
+
+
+def paint_footprints(road_occupancy, replicas, rear_bumper_positions, lengths, rows, widths, values):
+    """Writes values on the cells covered by many vehicle footprints at once, wrapping around the periodic boundary"""
+    if len(rear_bumper_positions) == 0:
+        return
+    road_length, road_width = road_occupancy.shape[1], road_occupancy.shape[2]
+    cell_starts = np.cumsum(lengths) - lengths
+    offsets = np.arange(np.sum(lengths)) - np.repeat(cell_starts, lengths)
+    replica_cells = np.repeat(replicas, lengths)
+    x_cells = (np.repeat(rear_bumper_positions, lengths) + offsets) % road_length
+    row_cells = np.repeat(rows, lengths)
+    width_cells = np.repeat(widths, lengths)
+    value_cells = np.repeat(values, lengths)
+    for row_offset in range(int(np.max(widths))):
+        inside = (row_offset < width_cells) & (row_cells + row_offset < road_width)
+        road_occupancy[replica_cells[inside], x_cells[inside], row_cells[inside] + row_offset] = value_cells[inside]
+
+
+def interacts_with_passengers(sidewalk_occupancy, state, replicas, slots):
+    """Flags the jeepneys that carry passengers or have waiting passengers beside or ahead of them (they need the per-vehicle rules)"""
+    is_jeep = state.vehicle_type[replicas, slots] == VEHICLE_TYPE_CODES["jeep"]
+    waiting_cells = sidewalk_occupancy[:, :, 0] > 0
+    distance_to_waiting = distance_to_next_occupied(waiting_cells, replicas, state.rear_bumper_position[replicas, slots])
+    sight_distance = state.length[replicas, slots] + state.max_speed[replicas, slots] + 1
+    return is_jeep & ((state.occupied_seats[replicas, slots] > 0) | (distance_to_waiting < sight_distance))
+
+
+def wants_to_change_lanes(road_occupancy, state, replicas, slots, lane_change_rolls):
+    """Flags the vehicles that roll a lane change and whose accelerated speed does not fit in their own lane (otherwise lane_changing() does nothing)"""
+    accelerated_speeds = np.minimum(state.speed[replicas, slots] + 1, state.max_speed[replicas, slots])
+    rolled = lane_change_rolls < state.lane_changing_prob[replicas, slots]
+    return rolled & (accelerated_speeds > gaps_ahead(road_occupancy, state, replicas, slots))
+
+
+def needs_sequential_update(road_occupancy, sidewalk_occupancy, state, replicas, slots, lane_change_rolls):
+    """Flags the vehicles that must go through the per-vehicle rules: straddling, changing lanes or interacting with passengers"""
+    straddling = state.current_row[replicas, slots] == 1
+    changing_lanes = wants_to_change_lanes(road_occupancy, state, replicas, slots, lane_change_rolls)
+    return straddling | changing_lanes | interacts_with_passengers(sidewalk_occupancy, state, replicas, slots)
+
+
+def advance(road_occupancy, state, replicas, slots, rngs):
+    """Synchronous update of the given vehicles: accelerate, gap-limited decelerate, random slowdown and move.
+    Gaps are measured on the road occupancy at the start of the pass, so every vehicle sees the others at their old positions.
+    rngs holds the np.random.Generator of each replica, the slowdown rolls of a replica come from its own generator."""
+    rear_bumper_positions = state.rear_bumper_position[replicas, slots]
+    lengths = state.length[replicas, slots]
+    widths = state.width[replicas, slots]
+    rows = state.current_row[replicas, slots]
+    speeds = np.minimum(state.speed[replicas, slots] + 1, state.max_speed[replicas, slots]) #accelerate
+    speeds = np.minimum(speeds, gaps_ahead(road_occupancy, state, replicas, slots)) #decelerate to the gap
+    slowdown_rolls = np.empty(len(slots))
+    for replica in np.unique(replicas):
+        in_replica = replicas == replica
+        slowdown_rolls[in_replica] = rngs[replica].random(np.count_nonzero(in_replica))
+    slowdown = (slowdown_rolls < state.braking_prob[replicas, slots]) & (speeds > 0) #random slowdown
+    speeds -= slowdown
+    new_rear_bumper_positions = (rear_bumper_positions + speeds) % road_occupancy.shape[1] #move
+    paint_footprints(road_occupancy, replicas, rear_bumper_positions, lengths, rows, widths, np.zeros(len(slots)))
+    paint_footprints(road_occupancy, replicas, new_rear_bumper_positions, lengths, rows, widths, state.vehicle_type[replicas, slots])
+    state.speed[replicas, slots] = speeds
+    state.previous_rear_bumper_position[replicas, slots] = rear_bumper_positions
+    state.rear_bumper_position[replicas, slots] = new_rear_bumper_positions
+    return
@@ -1,10 +1,10 @@
 import numpy as np
 
+from passenger_registry import PassengerState
+
 class Passenger:
-    _id_counter = 0
-    def __init__(self, sidewalk_entry_time, sidewalk, road_designation, sidewalk_position, destination_stop, vehicle_simulator, passenger_simulator):
-        self.passenger_id = Passenger._id_counter #identifying number of each passenger
-        Passenger._id_counter += 1 #increment passenger id based on order of initialization
+    def __init__(self, sidewalk_entry_time, sidewalk, road_designation, sidewalk_position, destination_stop, vehicle_simulator, passenger_simulator, passenger_id):
+        self.passenger_id = passenger_id #identifying number of each passenger, allocated by the passenger simulator in order of initialization
         self.sidewalk_entry_time = sidewalk_entry_time #The time where the passenger spawned on the sidewalk
         self.sidewalk = sidewalk #passenger knows on which sidewalk he/she is
         self.road_designation = road_designation #passenger knows on what road he/she is
@@ -28,6 +28,8 @@ class Passenger:
         self.about_to_cross_edge = None
         self.data = {"id": self.passenger_id, "destination":self.destination_stop}
         self.let_me_out = None
+        self.state = None #Lifecycle state (PassengerState), kept by the PassengerRegistry
+        self.state_slot = None #Index of the passenger in the registry list of its state
 
     def board_vehicle(self, vehicle, current_time):
         """This logic decides if the passenger boards the vehicle if all the conditions are satisifed:
@@ -45,8 +47,9 @@ class Passenger:
         # print(f"Passenger {self.passenger_id} boarded {vehicle.vehicle_type} {vehicle.vehicle_id} from loading list {self.sidewalk.stops[self.destination_stop.position][0].loading_list}. ")
         # print(f"Passenger {self.passenger_id} is in {vehicle.vehicle_type} {vehicle.vehicle_id}, and in the unloading list {self.sidewalk.stops[self.destination_stop.position][0].unloading_list}. ")
         #self.sidewalk.stops[self.destination_stop.position][0].loading_list.remove(self) - not needed since pop automatically removes the passenger from the loading list
-        self.passenger_simulator.waiting_passengers.remove(self)
-        self.passenger_simulator.in_transit_passengers.append(self)
+        self.passenger_simulator.registry.transition(self, PassengerState.IN_TRANSIT)
+        self.passenger_simulator.update_stop_occupancy(self.last_sidewalk_position) #The passenger left the loading list of the stop
+        self.passenger_simulator.boarded_at[self.last_sidewalk_position] += 1
         #print(f"Passenger {self.passenger_id} boarded {vehicle.vehicle_type} {vehicle.vehicle_id}")
         self.just_boarded = True
         vehicle.determine_cross_edge()
@@ -69,8 +72,8 @@ class Passenger:
         stop.unloading_dictionary.pop(self.passenger_id, None)
         stop.unloading_list.remove(self)
         vehicle.passengers_on_board.pop(self.passenger_id, None)
-        self.passenger_simulator.in_transit_passengers.remove(self)
-        self.passenger_simulator.alighted_passengers.append(self)
+        self.passenger_simulator.registry.transition(self, PassengerState.ALIGHTED)
+        self.passenger_simulator.alighted_at[self.destination_stop.position] += 1
         # print(f"Passenger {self.passenger_id} alighted the jeepney.")
         # print(f"Passenger {self.passenger_id} has reached his destination at {self.destination_stop}.")
         #print(f"The passengers within the vehicle are {vehicle.passengers_within_vehicle}")
@@ -0,0 +1,67 @@
+from enum import Enum
+
+
+class PassengerState(Enum):
+    WAITING = "Waiting"
+    IN_TRANSIT = "In-Transit"
+    ALIGHTED = "Alighted"
+
+
+ACTIVE_STATES = (PassengerState.WAITING, PassengerState.IN_TRANSIT)
+
+
+class PassengerRegistry:
+    """Every passenger spawned during a run, in spawn order, plus one list per lifecycle state.
+    Each passenger stores its state and its slot in the list of that state, so a transition is a swap-remove and an append.
+    After stream_alighted, alighted passengers are handed to a record writer and forgotten, and only the active
+    passengers are kept (passengers then stays empty)."""
+
+    def __init__(self):
+        self.passengers = [] #All passengers, in spawn order
+        self.by_state = {state: [] for state in PassengerState}
+        self.spawned = 0
+        self.alighted_writer = None #Record writer of the alighted passengers (see stream_alighted)
+
+    def __len__(self):
+        return self.spawned
+
+    def stream_alighted(self, writer):
+        """Hands every passenger that alights from now on to writer.add instead of keeping it"""
+        self.alighted_writer = writer
+
+    def __iter__(self):
+        return iter(self.passengers)
+
+    def add(self, passenger):
+        """Registers a newly spawned passenger as waiting"""
+        self.spawned += 1
+        if self.alighted_writer is None:
+            self.passengers.append(passenger)
+        passenger.state = None
+        self.transition(passenger, PassengerState.WAITING)
+
+    def transition(self, passenger, new_state):
+        """Moves the passenger to the list of new_state in O(1) (the order within a state list is not preserved)"""
+        if passenger.state is not None:
+            members = self.by_state[passenger.state]
+            last = members.pop()
+            if last is not passenger: #Fill the hole with the last member
+                members[passenger.state_slot] = last
+                last.state_slot = passenger.state_slot
+        if new_state is PassengerState.ALIGHTED and self.alighted_writer is not None:
+            passenger.state, passenger.state_slot = new_state, None
+            self.alighted_writer.add(passenger)
+            return
+        members = self.by_state[new_state]
+        passenger.state = new_state
+        passenger.state_slot = len(members)
+        members.append(passenger)
+
+    def in_state(self, state):
+        """List of the passengers currently in a state (do not modify it)"""
+        return self.by_state[state]
+
+    def active(self):
+        """Iterates over the passengers that have not alighted yet"""
+        for state in ACTIVE_STATES:
+            yield from self.by_state[state]
@@ -5,27 +5,50 @@ import matplotlib.colors as mcolors
 from passenger import Passenger
 from sidewalk import Sidewalk
 from stop import Stop
+from passenger_registry import PassengerRegistry, PassengerState
+from random_streams import as_generator
 
 class Passenger_Simulator:
-    def __init__(self, sidewalk:Sidewalk, passenger_arrival_rate, road_designation, max_passengers_per_cell, vehicle_simulator):
+    def __init__(self, sidewalk:Sidewalk, passenger_arrival_rate, road_designation, max_passengers_per_cell, vehicle_simulator, arrival_sampling="bernoulli", rng=None):
+        """arrival_sampling is "bernoulli" (one draw per stop per timestep, all stops in one vectorized call) or
+        "geometric" (each stop samples the time of its next arrival, so timesteps without arrivals draw nothing)
+        rng is the np.random.Generator (or np.random.RandomState) of the arrivals, the one of the vehicle simulator by default"""
+        if arrival_sampling not in ("bernoulli", "geometric"):
+            raise ValueError(f"Unknown arrival sampling: {arrival_sampling}")
         self.sidewalk = sidewalk
         self.road_designation = road_designation
         self.passenger_arrival_rate = passenger_arrival_rate
-        self.passengers = []
+        self.registry = PassengerRegistry() #Lifecycle state of every passenger
+        self.passengers = self.registry.passengers #All passengers, in spawn order
         self.current_time = 0
-        self.sidewalk_occupancy_history = []
 
         self.total_passengers = 0
+        self.next_passenger_id = 0 #ID of the next passenger spawned, reset at the start of every run
         self.total_passengers_loaded = 0
         self.total_passengers_unloaded = 0
         self.max_passengers_per_cell = max_passengers_per_cell
         self.vehicle_simulator = vehicle_simulator
+        self.rng = as_generator(rng) if rng is not None else vehicle_simulator.rng
 
         self.cmap = mcolors.LinearSegmentedColormap.from_list("white_to_dark_red", ["white", "darkred"])
         self.norm = mcolors.Normalize(vmin=0, vmax=5)  # Normalize the range of values to 0-5
-        self.waiting_passengers = []
-        self.in_transit_passengers = []
-        self.alighted_passengers = []
+        self.arrival_sampling = arrival_sampling
+        self.stop_positions = np.arange(0) #Sidewalk cells with a designated stop
+        self.next_arrival_times = None #Next arrival timestep of each stop (geometric sampling)
+        self.boarded_at = np.zeros(sidewalk.length, dtype=np.int64) #Passengers that boarded at each sidewalk cell since the stops were generated
+        self.alighted_at = np.zeros(sidewalk.length, dtype=np.int64) #Passengers that alighted at each sidewalk cell
+
+    @property
+    def waiting_passengers(self):
+        return self.registry.in_state(PassengerState.WAITING)
+
+    @property
+    def in_transit_passengers(self):
+        return self.registry.in_state(PassengerState.IN_TRANSIT)
+
+    @property
+    def alighted_passengers(self):
+        return self.registry.in_state(PassengerState.ALIGHTED)
 
     def update_occupancy(self, timestep):
         """
@@ -45,6 +68,13 @@ class Passenger_Simulator:
         # print(f"Hence, sidewalk occupancy is {self.sidewalk.occupancy}.")
         #self.sidewalk_occupancy_history.append(self.sidewalk.occupancy.copy())
 
+    def update_stop_occupancy(self, position):
+        """Update the sidewalk occupancy of a single stop cell after its loading list changed."""
+        if self.sidewalk.stops[position]:
+            self.sidewalk.occupancy[position] = len(self.sidewalk.stops[position][0].loading_list)
+        else:
+            self.sidewalk.occupancy[position] = 0
+
     def generate_stops(self, stop_to_stop_distance):
         """
         Generate stops at regular intervals along the sidewalk.
@@ -56,46 +86,45 @@ class Passenger_Simulator:
         for position in range(0, self.sidewalk.length, stop_to_stop_distance):
             new_stop = Stop(position, stop_id)
             self.sidewalk.stops[position].append(new_stop)
+        self.sidewalk.stop_visibility.clear()
+        self.stop_positions = np.array([position for position in range(self.sidewalk.length) if self.sidewalk.stops[position]])
+        self.next_arrival_times = None
+        self.boarded_at.fill(0)
+        self.alighted_at.fill(0)
         #print(f"The  stops generated are {self.sidewalk.stops}")
 
     def generate_passengers(self, vehicle_simulator, current_time_pass):#Put an algorithm that generates passengers only on designated stops
         """Generate new passengers based on the arrival rate and places them on the sidewalk."""
-        for position in range(0, self.sidewalk.length):
-            #print(f"The position being checked for additional passenger is {col}")
-            #print(f"The stops at position {position} is {self.sidewalk.boarding_stops[position]}")
-            if len(self.sidewalk.stops[position]) != 0: #We spawn passengers on sidewalk cells with designated stops only (Here, we check for the presence of a stop)
-                
-                # if self.sidewalk.frozen_cells[position]:# **Skip frozen cells**
-                #     print(f"Sidewalk position {position} skipped, frozen.")
-                #     continue
-                
-                if np.random.random() < self.passenger_arrival_rate:
-                    if self.sidewalk.occupancy[position, 0] < self.sidewalk.max_passengers_per_cell:
-                        destination = None 
-                        set_of_stops = self.sidewalk.stops
-                        
-                        for stop_list in set_of_stops:
-                            for stop in stop_list:
-                                if stop.position == position: #(position - 10) % self.road_designation.length:
-                                    destination = stop #Dirac-delta distribution of distances
-
-                        # print(f"The destination position for the passenger initiated at position {position} is {position}")
-                        new_passenger = Passenger(current_time_pass, self.sidewalk, 
-                        self.road_designation, position, 
-                        destination, vehicle_simulator, self)
-                        # print(f"Passenger {new_passenger.passenger_id}'s destinations at {new_passenger.destination_stop}")
-                        self.passengers.append(new_passenger)
-                        # print(f"The passenger list after the passenger is placed at {position} is {self.passengers}")
-                        #self.sidewalk.passengers[position].append(new_passenger)
-                        #print(f"The sidewalk list where passenger is at position {col} is {self.sidewalk.passengers[col]}")
-                        self.sidewalk.stops[position][0].loading_list.append(new_passenger)
-                        # print(f"Passenger {new_passenger.passenger_id} is added to Stop at {self.sidewalk.stops[position][0].position}. The loading list is {self.sidewalk.stops[position][0].loading_list}.")
-                        self.waiting_passengers.append(new_passenger)
-                        self.update_occupancy(self.current_time)
-                        #print(f"Passenger added at position {position}.")
-                        #print(f"Passenger {new_passenger.passenger_id} was added to position {position}, where the destination is at {destination_position}.")
+        for position in self.arriving_stop_positions(current_time_pass): #We spawn passengers on sidewalk cells with designated stops only
+            if self.sidewalk.occupancy[position, 0] < self.sidewalk.max_passengers_per_cell:
+                destination = self.sidewalk.stops[position][-1] #Dirac-delta distribution of distances (the stop where the passenger spawned)
+
+                new_passenger = Passenger(current_time_pass, self.sidewalk, 
+                self.road_designation, position, 
+                destination, vehicle_simulator, self, self.next_passenger_id)
+                self.next_passenger_id += 1
+                # print(f"Passenger {new_passenger.passenger_id}'s destinations at {new_passenger.destination_stop}")
+                self.registry.add(new_passenger) #Starts as a waiting passenger
+                self.sidewalk.stops[position][0].loading_list.append(new_passenger)
+                # print(f"Passenger {new_passenger.passenger_id} is added to Stop at {self.sidewalk.stops[position][0].position}. The loading list is {self.sidewalk.stops[position][0].loading_list}.")
+                self.update_stop_occupancy(position) #Only this stop's count changed
         # print(f"Time {self.current_time}: {len(self.passengers)} passengers generated.")
 
+    def arriving_stop_positions(self, timestep):
+        """Positions of the stops where a passenger arrives at this timestep, in increasing order"""
+        if self.arrival_sampling == "bernoulli":
+            arrivals = self.rng.random(len(self.stop_positions)) < self.passenger_arrival_rate #Same draws as one rng.random() per stop
+            return self.stop_positions[arrivals].tolist()
+
+        arrival_probability = min(self.passenger_arrival_rate, 1) #Rates above 1 mean an arrival every timestep, as in the Bernoulli draws
+        if arrival_probability <= 0:
+            return []
+        if self.next_arrival_times is None: #First arrival: the first success of a Bernoulli process starting now
+            self.next_arrival_times = timestep - 1 + self.rng.geometric(arrival_probability, len(self.stop_positions))
+        arrivals = self.next_arrival_times == timestep
+        self.next_arrival_times[arrivals] += self.rng.geometric(arrival_probability, np.count_nonzero(arrivals))
+        return self.stop_positions[arrivals].tolist()
+
     def visualize(self, step_count):
         """Visualize the sidewalk occupancy using a colormap."""
         plt.figure(figsize=(20, 6))
@@ -0,0 +1,13 @@
+import numpy as np
+
+
+def window_cells(grid, start, stop):
+    """Cells start to stop - 1 along the first (periodic) axis of a grid, without rolling the whole grid.
+    Positions may lie outside [0, length), the window wraps around the boundary and is at most one period long.
+    Returns a view unless the window crosses the boundary (then only the window cells are copied)."""
+    length = grid.shape[0]
+    start_cell = start % length
+    stop_cell = start_cell + min(max(stop - start, 0), length)
+    if stop_cell <= length:
+        return grid[start_cell:stop_cell]
+    return np.concatenate((grid[start_cell:], grid[:stop_cell - length]))
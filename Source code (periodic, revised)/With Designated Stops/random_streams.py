@@ -0,0 +1,45 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+class LegacyRandomState:
+    """np.random.Generator-like view of an np.random.RandomState: the methods the simulators call on their generator,
+    drawing the legacy streams. A run given np.random.RandomState(seed) reproduces a run made under np.random.seed(seed)
+    before the simulators took a generator (Generator.integers, shuffle and choice use other algorithms than RandomState)."""
+
+    def __init__(self, random_state):
+        self.random_state = random_state
+
+    def random(self, size=None):
+        return self.random_state.random_sample(size)
+
+    def integers(self, low, high=None, size=None):
+        return self.random_state.randint(low, high, size)
+
+    def shuffle(self, values):
+        self.random_state.shuffle(values)
+
+    def choice(self, values, size=None):
+        return self.random_state.choice(values, size)
+
+    def geometric(self, p, size=None):
+        return self.random_state.geometric(p, size)
+
+
+def as_generator(rng=None, seed=None):
+    """Random number generator of a run: rng itself for an np.random.Generator, a LegacyRandomState for an
+    np.random.RandomState, and np.random.default_rng(seed) without rng"""
+    if rng is None:
+        return np.random.default_rng(seed)
+    if isinstance(rng, np.random.RandomState):
+        return LegacyRandomState(rng)
+    return rng
+
+
+def trial_rng(seed, case, density, kappa, arrival_rate, stop_to_stop_distance, trial):
+    """np.random.Generator of one trial of a sweep: a SeedSequence of the sweep seed with a spawn key derived from the trial's
+    configuration, so every trial has its own reproducible stream whichever worker, node or batch runs it"""
+    key_digest = hashlib.sha256(json.dumps((case, density, kappa, arrival_rate, stop_to_stop_distance, trial)).encode()).digest()
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=tuple(np.frombuffer(key_digest, dtype=np.uint32).tolist())))
@@ -0,0 +1,323 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+class GridRecorder:
+    """Spatio-temporal record of the road and sidewalk occupancies. Each recorded step is written straight into
+    preallocated disk-backed arrays (np.memmap): uint8 for the road codes (0 empty, 1 jeep, 2 truck) and uint16 for the
+    sidewalk passenger counts, so nothing accumulates in memory during the run.
+    The backing files go to directory when given (kept after the run), otherwise to anonymous temporary files."""
+
+    def __init__(self, max_steps, road_shape, sidewalk_shape, directory=None):
+        capacity = max(1, max_steps) #np.memmap cannot map an empty file
+        self.road = self._allocate(capacity, road_shape, np.uint8, directory, "road_occupancy.dat")
+        self.sidewalk = self._allocate(capacity, sidewalk_shape, np.uint16, directory, "sidewalk_occupancy.dat")
+        self.timesteps = np.zeros(capacity, dtype=np.int64)
+        self.count = 0 #Number of recorded steps
+
+    @staticmethod
+    def _allocate(capacity, shape, dtype, directory, filename):
+        if directory is None:
+            with tempfile.TemporaryFile() as backing_file: #The mapping keeps the storage alive after the file is closed
+                return np.memmap(backing_file, dtype=dtype, mode="w+", shape=(capacity,) + tuple(shape))
+        os.makedirs(directory, exist_ok=True)
+        return np.memmap(os.path.join(directory, filename), dtype=dtype, mode="w+", shape=(capacity,) + tuple(shape))
+
+    def record(self, timestep, road_occupancy, sidewalk_occupancy):
+        if self.count == self.timesteps.shape[0]:
+            raise ValueError(f"The grid recorder is full ({self.count} steps)")
+        self.timesteps[self.count] = timestep
+        self.road[self.count] = road_occupancy
+        self.sidewalk[self.count] = sidewalk_occupancy
+        self.count += 1
+
+    def road_table(self):
+        """One row per (recorded timestep, road row) with the code of every position, as the RoadSpatioTemporal csv"""
+        return road_table(self.timesteps[:self.count], np.asarray(self.road[:self.count]))
+
+    def sidewalk_table(self):
+        """One row per recorded timestep with the number of passengers at every position (summed over the sidewalk width)"""
+        sidewalk = np.asarray(self.sidewalk[:self.count])
+        counts = sidewalk.sum(axis=2, dtype=np.int64) if sidewalk.ndim == 3 else sidewalk.astype(np.int64)
+        table = pd.DataFrame(counts, columns=[f"Pos {x}" for x in range(counts.shape[1])])
+        table.insert(0, "Timestep", self.timesteps[:self.count])
+        return table
+
+    def flush(self):
+        self.road.flush()
+        self.sidewalk.flush()
+
+
+class StopQueueRecorder:
+    """Queue length of every stop at every recorded step, a (steps x stops) uint16 array keyed by stop position.
+    Passengers only wait at stops, so this holds the same information as the sidewalk grid for a fraction of its size.
+    With count_events, the number of passengers that boarded and alighted at each stop since the previous recorded
+    step is stored too."""
+
+    def __init__(self, max_steps, stop_positions, count_events=False):
+        self.stop_positions = np.asarray(stop_positions, dtype=np.int64)
+        shape = (max_steps, self.stop_positions.shape[0])
+        self.timesteps = np.zeros(max_steps, dtype=np.int64)
+        self.queues = np.zeros(shape, dtype=np.uint16)
+        self.count_events = count_events
+        self.boarded = np.zeros(shape, dtype=np.uint16) if count_events else None
+        self.alighted = np.zeros(shape, dtype=np.uint16) if count_events else None
+        self.previous_boarded = np.zeros(shape[1], dtype=np.int64) #Cumulative counts at the previous recorded step
+        self.previous_alighted = np.zeros(shape[1], dtype=np.int64)
+        self.count = 0
+
+    def record(self, timestep, sidewalk_occupancy, boarded_at=None, alighted_at=None):
+        """Stores the queues of one step. boarded_at and alighted_at are the cumulative counts per sidewalk cell"""
+        if self.count == self.timesteps.shape[0]:
+            raise ValueError(f"The stop queue recorder is full ({self.count} steps)")
+        self.timesteps[self.count] = timestep
+        self.queues[self.count] = sidewalk_occupancy[self.stop_positions].reshape(self.stop_positions.shape[0], -1).sum(axis=1)
+        if self.count_events:
+            boarded, alighted = boarded_at[self.stop_positions], alighted_at[self.stop_positions]
+            self.boarded[self.count] = boarded - self.previous_boarded
+            self.alighted[self.count] = alighted - self.previous_alighted
+            self.previous_boarded, self.previous_alighted = boarded, alighted
+        self.count += 1
+
+    def table(self):
+        """One row per recorded timestep with a "Queue <position>" column per stop (and "Boarded <position>", "Alighted <position>")"""
+        table = pd.DataFrame({"Timestep": self.timesteps[:self.count]})
+        columns = [("Queue", self.queues)] + ([("Boarded", self.boarded), ("Alighted", self.alighted)] if self.count_events else [])
+        for name, values in columns:
+            table = table.join(pd.DataFrame(values[:self.count], columns=[f"{name} {position}" for position in self.stop_positions]))
+        return table
+
+
+PASSENGER_RECORD_DTYPE = np.dtype([("Passenger ID", np.int64), ("Riding Time", np.int64), ("Waiting Time", np.int64),
+                                    ("Spawning Time", np.int64), ("Boarding Time", np.int64), ("Alighting Time", np.int64)])
+
+
+class PassengerRecordWriter:
+    """Columnar records of the passengers that reached their destination. Records are collected in batches of
+    batch_size and each full batch is appended to a file (in directory when given, an anonymous temporary file otherwise),
+    so the Passenger objects can be dropped as soon as they alight."""
+
+    def __init__(self, batch_size=1000, directory=None):
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0 #Number of records, written or not
+        if directory is None:
+            self.file = tempfile.TemporaryFile()
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.file = open(os.path.join(directory, "alighted_passengers.npy"), "w+b")
+
+    def add(self, passenger):
+        boarding_time, alighting_time = passenger.jeep_boarding_time, passenger.arrived_at_destination_time
+        self.batch.append((passenger.passenger_id, alighting_time - boarding_time, boarding_time - passenger.sidewalk_entry_time,
+                           passenger.sidewalk_entry_time, boarding_time, alighting_time))
+        self.count += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            np.save(self.file, np.array(self.batch, dtype=PASSENGER_RECORD_DTYPE)) #Batches are stored back to back in the file
+            self.batch = []
+        self.file.flush()
+
+    def records(self):
+        """Structured array of every record, in alighting order"""
+        self.flush()
+        size = os.fstat(self.file.fileno()).st_size
+        self.file.seek(0)
+        batches = []
+        while self.file.tell() < size:
+            batches.append(np.load(self.file))
+        self.file.seek(0, os.SEEK_END)
+        return np.concatenate(batches) if batches else np.zeros(0, dtype=PASSENGER_RECORD_DTYPE)
+
+    def close(self):
+        self.file.close()
+
+
+def road_table(timesteps, grids):
+    """SpatioTemporal table of a stack of (timestep, position, row) road grids: one row per (timestep, road row)"""
+    steps, road_length, road_width = grids.shape
+    rows = grids.transpose(0, 2, 1).reshape(steps * road_width, road_length)
+    table = pd.DataFrame(rows.astype(np.float64), columns=[f"Pos {x}" for x in range(road_length)]) #Float codes, as the road occupancy grid
+    table.insert(0, "Road Row", np.tile(np.arange(road_width), steps))
+    table.insert(0, "Timestep", np.repeat(timesteps, road_width))
+    return table
+
+
+TRAJECTORY_COLUMNS = {"Timestep": np.int64, "Vehicle ID": np.int64, "Vehicle Type": np.int8, "Length": np.int8, "Width": np.int8,
+                      "Rear Bumper Position": np.int16, "Row": np.int8, "Speed": np.int8}
+
+
+class TrajectoryRecorder:
+    """Vehicle trajectories: rear bumper position (int16), row and speed (int8) of every vehicle at every recorded step.
+    The road grid is fully determined by these and the type, length and width of each vehicle, so reconstruct_grids
+    regenerates the SpatioTemporal grids of any time window from a fraction of their size.
+    The set of vehicles is fixed by the first recorded step (vehicles are only spawned while the road is populated)."""
+
+    def __init__(self, max_steps, changes_only=False):
+        self.max_steps = max_steps
+        self.changes_only = changes_only #Only keep the rows of a vehicle whose position, row or speed changed in the table
+        self.timesteps = np.zeros(max_steps, dtype=np.int64)
+        self.count = 0
+        self.vehicle_ids = None #Static attributes of the vehicles, one column per vehicle, set by set_vehicles
+        self.vehicle_types = None
+        self.lengths = None
+        self.widths = None
+        self.positions = self.rows = self.speeds = None
+
+    def set_vehicles(self, vehicle_ids, vehicle_types, lengths, widths):
+        """Declares the recorded vehicles (vehicle_types are the road occupancy codes)"""
+        self.vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+        self.vehicle_types = np.asarray(vehicle_types, dtype=np.int8)
+        self.lengths = np.asarray(lengths, dtype=np.int8)
+        self.widths = np.asarray(widths, dtype=np.int8)
+        shape = (self.max_steps, self.vehicle_ids.shape[0])
+        self.positions = np.zeros(shape, dtype=np.int16)
+        self.rows = np.zeros(shape, dtype=np.int8)
+        self.speeds = np.zeros(shape, dtype=np.int8)
+
+    def record(self, timestep, positions, rows, speeds):
+        """Stores one step, the arrays are in the order of the vehicles given to set_vehicles"""
+        if self.count == self.max_steps:
+            raise ValueError(f"The trajectory recorder is full ({self.count} steps)")
+        self.timesteps[self.count] = timestep
+        self.positions[self.count] = positions
+        self.rows[self.count] = rows
+        self.speeds[self.count] = speeds
+        self.count += 1
+
+    def table(self):
+        """Long table with one row per (recorded timestep, vehicle), or per change of a vehicle with changes_only"""
+        steps = self.count
+        if self.vehicle_ids is None or steps == 0:
+            return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in TRAJECTORY_COLUMNS.items()})
+        positions, rows, speeds = self.positions[:steps], self.rows[:steps], self.speeds[:steps]
+        keep = np.ones(positions.shape, dtype=bool)
+        if self.changes_only:
+            keep[1:] = (positions[1:] != positions[:-1]) | (rows[1:] != rows[:-1]) | (speeds[1:] != speeds[:-1])
+        step_index, vehicle_index = np.nonzero(keep)
+        return pd.DataFrame({
+            "Timestep": self.timesteps[step_index],
+            "Vehicle ID": self.vehicle_ids[vehicle_index],
+            "Vehicle Type": self.vehicle_types[vehicle_index],
+            "Length": self.lengths[vehicle_index],
+            "Width": self.widths[vehicle_index],
+            "Rear Bumper Position": positions[keep],
+            "Row": rows[keep],
+            "Speed": speeds[keep]})
+
+
+def trajectory_arrays(trajectories, timesteps):
+    """(timesteps x vehicles) arrays of rear bumper positions and rows from a trajectory table, plus the (type, length, width)
+    of each vehicle. A vehicle missing at a timestep (changes_only tables) keeps its last recorded state;
+    before its first record it is absent (row -1)."""
+    trajectories = trajectories.sort_values(["Vehicle ID", "Timestep"], kind="stable")
+    vehicle_ids, first_rows = np.unique(trajectories["Vehicle ID"].to_numpy(), return_index=True)
+    record_times = trajectories["Timestep"].to_numpy()
+    record_positions = trajectories["Rear Bumper Position"].to_numpy()
+    record_rows = trajectories["Row"].to_numpy()
+    ends = np.append(first_rows[1:], len(trajectories))
+    timesteps = np.asarray(timesteps)
+    positions = np.zeros((timesteps.shape[0], vehicle_ids.shape[0]), dtype=np.int64)
+    rows = np.full((timesteps.shape[0], vehicle_ids.shape[0]), -1, dtype=np.int64)
+    for column, (start, end) in enumerate(zip(first_rows, ends)):
+        latest = start + np.searchsorted(record_times[start:end], timesteps, side="right") - 1 #Last record at or before each timestep
+        present = latest >= start
+        positions[present, column] = record_positions[latest[present]]
+        rows[present, column] = record_rows[latest[present]]
+    static = trajectories.iloc[first_rows]
+    return positions, rows, static["Vehicle Type"].to_numpy(), static["Length"].to_numpy(), static["Width"].to_numpy()
+
+
+def reconstruct_grids(trajectories, road_length, road_width, start=None, stop=None, timesteps=None):
+    """Regenerates the road occupancy grids of the timesteps in [start, stop) from a trajectory table.
+    timesteps defaults to the timesteps present in the table (a changes_only table has no row for a step where nothing
+    moved, pass the recorded timesteps to get those too). Returns the timesteps and a (timesteps, road_length, road_width)
+    uint8 array of vehicle codes"""
+    timesteps = np.unique(trajectories["Timestep"].to_numpy() if timesteps is None else timesteps)
+    if start is not None:
+        timesteps = timesteps[timesteps >= start]
+    if stop is not None:
+        timesteps = timesteps[timesteps < stop]
+    positions, rows, vehicle_types, lengths, widths = trajectory_arrays(trajectories, timesteps)
+    grids = np.zeros((timesteps.shape[0], road_length, road_width), dtype=np.uint8)
+    step_index, vehicle_index = np.nonzero(rows >= 0) #Vehicles present at each timestep
+    for length, width in set(zip(lengths.tolist(), widths.tolist())): #Paint the vehicles of one footprint size at a time
+        in_group = (lengths[vehicle_index] == length) & (widths[vehicle_index] == width)
+        steps, vehicles = step_index[in_group], vehicle_index[in_group]
+        cells = (positions[steps, vehicles][:, None] + np.arange(length)) % road_length
+        footprint_rows = rows[steps, vehicles][:, None] + np.arange(width)
+        grids[steps[:, None, None], cells[:, :, None], footprint_rows[:, None, :]] = vehicle_types[vehicles][:, None, None]
+    return timesteps, grids
+
+
+def space_time_diagram(grids):
+    """(timesteps, road_length) diagram of the vehicle code covering each position on any row"""
+    return grids.max(axis=2)
+
+
+DEFAULT_TABLES = ("TimestepSummary", "PassengerData", "VehicleData", "SpatioTemporal", "SidewalkPatioTemporal")
+RESULT_TABLES = DEFAULT_TABLES + ("VehicleTrajectories", "StopQueues") #Order of the tables returned by a run
+
+
+class RecordingPolicy:
+    """Which result tables a run records, and at which timesteps.
+    The per-step tables (TimestepSummary, SpatioTemporal, SidewalkPatioTemporal) are recorded every stride-th step,
+    from transient_time on when after_transient is set and only over the last last_steps steps when given.
+    PassengerData and VehicleData are built once at the end of the run. With trials, only those trials record anything.
+    A table that is not recorded is returned as None. VehicleTrajectories (see TrajectoryRecorder) is off by default,
+    trajectory_changes_only only keeps the rows of the vehicles that moved, changed rows or changed speed.
+    StopQueues (see StopQueueRecorder) is off by default too, it replaces SidewalkPatioTemporal for queue analyses and
+    stop_events adds the boarded and alighted counts of every stop.
+    With passenger_batch_size, the records of the alighted passengers are written to disk in batches of that size
+    (see PassengerRecordWriter) and the passengers are dropped from memory."""
+
+    def __init__(self, outputs=DEFAULT_TABLES, stride=1, after_transient=False, last_steps=None, trials=None, trajectory_changes_only=False, stop_events=False,
+                 passenger_batch_size=None):
+        unknown = set(outputs) - set(RESULT_TABLES)
+        if unknown:
+            raise ValueError(f"Unknown result tables: {sorted(unknown)}")
+        if stride < 1:
+            raise ValueError(f"The recording stride must be at least 1, got {stride}")
+        if last_steps is not None and last_steps < 0:
+            raise ValueError(f"last_steps cannot be negative, got {last_steps}")
+        self.outputs = frozenset(outputs)
+        self.stride = stride
+        self.after_transient = after_transient
+        self.last_steps = last_steps
+        self.trials = None if trials is None else frozenset(trials)
+        self.trajectory_changes_only = trajectory_changes_only
+        self.stop_events = stop_events
+        self.passenger_batch_size = passenger_batch_size
+
+    def for_trial(self, trial):
+        """The policy of one trial: this policy, or a policy recording nothing when the trial is not selected"""
+        if self.trials is None or trial in self.trials:
+            return self
+        return RecordingPolicy(outputs=(), stride=self.stride, after_transient=self.after_transient, last_steps=self.last_steps,
+                               trajectory_changes_only=self.trajectory_changes_only, stop_events=self.stop_events,
+                               passenger_batch_size=self.passenger_batch_size)
+
+    def records(self, output):
+        return output in self.outputs
+
+    def first_step(self, max_timesteps, transient_time):
+        """First timestep that can be recorded"""
+        first_step = transient_time if self.after_transient else 0
+        if self.last_steps is not None:
+            first_step = max(first_step, max_timesteps - self.last_steps)
+        return first_step
+
+    def records_step(self, timestep, max_timesteps, transient_time):
+        first_step = self.first_step(max_timesteps, transient_time)
+        return timestep >= first_step and (timestep - first_step) % self.stride == 0
+
+    def steps_to_record(self, max_timesteps, transient_time):
+        """Number of timesteps below max_timesteps that records_step accepts"""
+        first_step = self.first_step(max_timesteps, transient_time)
+        return max(0, -(-(max_timesteps - first_step) // self.stride))
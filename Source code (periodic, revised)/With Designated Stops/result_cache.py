@@ -0,0 +1,69 @@
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import zipfile
+
+from recorders import RESULT_TABLES
+from result_store import write_trial, read_trial
+
+#Modules whose code decides the results of a run, the random streams of the trials and the simulator setup of the sweeps
+#(random_streams.trial_rng, batch_sim.run_trials) included: a change to any of them changes the engine version
+ENGINE_MODULES = ("batch_sim", "counter", "lane_index", "main_sim", "parallel_update", "passenger", "passenger_registry", "passenger_sim",
+                  "periodic_window", "random_streams", "recorders", "road", "sidewalk", "speed_stats", "stop", "vehicle", "vehicle_sim",
+                  "vehicle_state")
+
+
+def module_source(name):
+    """Bytes of the source file of a module, found without importing it"""
+    with open(importlib.util.find_spec(name).origin, "rb") as source_file:
+        return source_file.read()
+
+
+@functools.lru_cache(maxsize=None)
+def engine_version():
+    """SHA-256 of the source of the ENGINE_MODULES"""
+    digest = hashlib.sha256()
+    for name in ENGINE_MODULES:
+        digest.update(name.encode())
+        digest.update(module_source(name))
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def params_version(params_file):
+    """SHA-256 of the source of a case parameter module"""
+    return hashlib.sha256(module_source(params_file)).hexdigest()
+
+
+def configuration_digest(configuration):
+    """SHA-256 of a JSON-serialisable configuration, independent of the key order"""
+    return hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """Result tables of trials stored under the digest of their full configuration (see configuration_digest), so a trial
+    whose inputs did not change is read back instead of simulated again. Entries are write_trial containers in
+    directory/<first two digest characters>/<digest>.npz, written under a temporary name and renamed into place."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], f"{digest}.npz")
+
+    def get(self, digest):
+        """(results in RESULT_TABLES order, metadata) of a cached trial, None when it is missing or unreadable"""
+        try:
+            tables, metadata = read_trial(self.path(digest))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        return tuple(tables.get(name) for name in RESULT_TABLES), metadata
+
+    def put(self, digest, results, metadata):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{os.getpid()}.partial"
+        write_trial(partial_path, dict(zip(RESULT_TABLES, results)), metadata)
+        os.replace(partial_path, path)
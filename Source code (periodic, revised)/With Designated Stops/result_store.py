@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import socket
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from recorders import RESULT_TABLES
+
+OUTPUT_FORMATS = ("csv", "npz")
+CHECKSUM_CHUNK_SIZE = 1 << 20
+
+
+def _compact(values):
+    """Smallest unsigned integer array holding a numeric column exactly, or the column itself"""
+    if values.dtype.kind not in "iuf" or values.size == 0:
+        return values
+    if values.dtype.kind == "f" and not (np.isfinite(values).all() and (values == np.round(values)).all()):
+        return values
+    if values.min() < 0:
+        return values
+    return values.astype(np.min_scalar_type(int(values.max())))
+
+
+def _column_array(column):
+    """NumPy array of a table column (text columns become fixed-width unicode arrays)"""
+    values = column.to_numpy()
+    if values.dtype.kind in "biuf":
+        return values
+    return np.asarray(values, dtype=str)
+
+
+def write_trial(path, tables, metadata):
+    """Writes the result tables of one trial (name -> DataFrame, None tables are skipped) and its run metadata
+    into a single compressed .npz container. The columns of a table that share a dtype are stored as one 2D block,
+    in the smallest integer type that holds them exactly, and read_trial restores the original dtypes."""
+    arrays = {}
+    layout = {}
+    for name, table in tables.items():
+        if table is None:
+            continue
+        columns = [_column_array(table[column]) for column in table.columns]
+        blocks = []
+        for dtype in dict.fromkeys(values.dtype for values in columns): #dtypes in order of first appearance
+            positions = [position for position, values in enumerate(columns) if values.dtype == dtype]
+            block = np.column_stack([columns[position] for position in positions]) if columns[positions[0]].size else np.empty((0, len(positions)), dtype=dtype)
+            key = f"{name}/{len(blocks)}"
+            arrays[key] = _compact(block)
+            blocks.append({"key": key, "columns": positions, "dtype": str(table[table.columns[positions[0]]].dtype)})
+        layout[name] = {"columns": [str(column) for column in table.columns], "rows": len(table), "blocks": blocks}
+    header = {"metadata": metadata, "tables": layout}
+    arrays["header"] = np.array(json.dumps(header, default=str))
+    with open(path, "wb") as output_file:
+        np.savez_compressed(output_file, **arrays)
+
+
+def read_trial(path):
+    """Reads a container written by write_trial, returns (tables, metadata) with tables a name -> DataFrame dict"""
+    with np.load(path) as container:
+        header = json.loads(str(container["header"]))
+        tables = {}
+        for name, layout in header["tables"].items():
+            columns = [None] * len(layout["columns"])
+            for block in layout["blocks"]:
+                values = container[block["key"]]
+                for index, position in enumerate(block["columns"]):
+                    columns[position] = pd.Series(values[:, index]).astype(block["dtype"]) #Back to the dtype of the original column
+            tables[name] = pd.DataFrame(dict(zip(layout["columns"], columns)))
+    return tables, header["metadata"]
+
+
+def save_trial(results, directory, filename, output_format="csv", metadata=None):
+    """Saves the result tables of a run (in RESULT_TABLES order, None for the tables that were not recorded).
+    "csv" writes one file per table in a subfolder named after the table, "npz" writes one container per trial.
+    Returns the paths written."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    tables = dict(zip(RESULT_TABLES, results))
+    if output_format == "npz":
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{filename}.npz")
+        write_trial(path, tables, metadata if metadata is not None else {})
+        return [path]
+    paths = []
+    for name, table in tables.items():
+        if table is None:
+            continue
+        folder = os.path.join(directory, name)
+        os.makedirs(folder, exist_ok=True)
+        paths.append(os.path.join(folder, f"{filename}.csv"))
+        table.to_csv(paths[-1], index=False)
+    return paths
+
+
+def file_checksum(file):
+    """SHA-256 of a file, given as a path or an open binary file"""
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as opened_file:
+            return file_checksum(opened_file)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CompletionLog:
+    """Append-only log of the completed trials of a sweep (completed-<host>-<pid>.jsonl in directory, one per writer).
+    Each line holds the key of a trial, the SHA-256 of its output files, relative to directory, the archive holding them
+    when they were published by a StagedPublisher and the run metadata of the trial. A line is written and synced once the files are in place,
+    so a crash loses at most the trials being saved. See read_completions."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"completed-{socket.gethostname()}-{os.getpid()}.jsonl")
+
+    def record(self, key, files, archive=None, metadata=None):
+        """Logs a completed trial, files being a relative path -> checksum dict"""
+        entry = {"key": list(key), "files": files}
+        if archive is not None:
+            entry["archive"] = archive
+        if metadata is not None:
+            entry["metadata"] = metadata
+        with open(self.path, "a") as log_file:
+            log_file.write(json.dumps(entry) + "\n")
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+    def record_paths(self, key, paths, metadata=None):
+        """Logs a completed trial from the paths of its files (in directory), checksumming them"""
+        self.record(key, {os.path.relpath(path, self.directory): file_checksum(path) for path in paths}, metadata=metadata)
+
+
+def read_completions(directory):
+    """Every trial logged by the CompletionLogs of directory, as a key tuple -> entry dict (the last entry of a key wins).
+    A line cut short by a crash is ignored."""
+    completions = {}
+    if not os.path.isdir(directory):
+        return completions
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("completed-") and name.endswith(".jsonl")):
+            continue
+        with open(os.path.join(directory, name)) as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                completions[tuple(entry["key"])] = entry
+    return completions
+
+
+def verify_completion(directory, entry):
+    """True when every file of a completion entry is in place with its logged checksum"""
+    try:
+        if "archive" in entry:
+            with zipfile.ZipFile(os.path.join(directory, entry["archive"])) as archive:
+                for path, checksum in entry["files"].items():
+                    with archive.open(path) as member:
+                        if file_checksum(member) != checksum:
+                            return False
+            return True
+        return all(file_checksum(os.path.join(directory, path)) == checksum for path, checksum in entry["files"].items())
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return False
+
+
+class BackgroundWriter:
+    """Runs save calls on a background thread, so the next trial can be computed while the last one is written.
+    The queue holds at most max_pending calls: submit blocks when it is full (backpressure), which bounds the memory
+    held by unsaved results. An error in a save is raised by the next submit, flush or close."""
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                function, args, kwargs = task
+                if self.error is None: #Stop writing after the first error, it is reported to the submitting side
+                    function(*args, **kwargs)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, function, *args, **kwargs):
+        self._raise_error()
+        self.queue.put((function, args, kwargs))
+
+    def flush(self):
+        """Waits until every submitted call ran"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Runs the pending calls and stops the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+
+class StagedPublisher:
+    """Writes the results of a worker to node-local scratch and publishes them to shared storage in batches.
+    Every batch_size staged trials are packed into one zip archive, copied next to its final name in destination and
+    renamed into place (atomic on one filesystem), so readers never see a partial archive. Each publisher keeps its own
+    manifest (manifest-<host>-<pid>.json in destination, replaced atomically) listing its published archives and the
+    files in each, see read_manifests. Inside an archive, files keep their path relative to destination.
+    With a completion_log, the trials saved with a key are logged once their archive is published."""
+
+    def __init__(self, scratch_directory, destination, batch_size=50, completion_log=None):
+        self.destination = destination
+        self.completion_log = completion_log
+        self.staged_completions = [] #(key, relative path -> checksum, metadata) of the staged trials saved with a key
+        self.batch_size = batch_size
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self.scratch = os.path.join(scratch_directory, f"staging-{self.name}")
+        self.staged = [] #Paths of the staged files, relative to the scratch directory
+        self.staged_trials = 0
+        self.published = [] #Manifest entries
+        os.makedirs(self.scratch, exist_ok=True)
+        os.makedirs(destination, exist_ok=True)
+
+    def save_trial(self, results, directory, filename, output_format="csv", metadata=None, key=None):
+        """save_trial into the scratch directory, directory being relative to destination. Publishes a full batch."""
+        paths = save_trial(results, os.path.join(self.scratch, directory), filename, output_format, metadata)
+        staged = [os.path.relpath(path, self.scratch) for path in paths]
+        self.staged.extend(staged)
+        if key is not None and self.completion_log is not None:
+            self.staged_completions.append((key, {path: file_checksum(os.path.join(self.scratch, path)) for path in staged}, metadata))
+        self.staged_trials += 1
+        if self.staged_trials >= self.batch_size:
+            self.publish()
+        return paths
+
+    def publish(self):
+        """Packs the staged files into one archive and moves it to the destination"""
+        if not self.staged:
+            return
+        archive_name = f"batch-{self.name}-{len(self.published):05d}.zip"
+        archive_path = os.path.join(self.scratch, archive_name)
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for path in self.staged:
+                archive.write(os.path.join(self.scratch, path), path)
+        partial_path = os.path.join(self.destination, f".{archive_name}.partial")
+        shutil.copyfile(archive_path, partial_path)
+        os.replace(partial_path, os.path.join(self.destination, archive_name))
+        self.published.append({"archive": archive_name, "trials": self.staged_trials, "files": self.staged})
+        self._write_manifest()
+        if self.completion_log is not None:
+            for key, files, metadata in self.staged_completions:
+                self.completion_log.record(key, files, archive=archive_name, metadata=metadata)
+        self.staged_completions = []
+        for path in self.staged + [archive_name]:
+            os.remove(os.path.join(self.scratch, path))
+        self.staged = []
+        self.staged_trials = 0
+
+    def _write_manifest(self):
+        manifest_path = os.path.join(self.destination, f"manifest-{self.name}.json")
+        with open(manifest_path + ".partial", "w") as manifest_file:
+            json.dump({"publisher": self.name, "archives": self.published}, manifest_file)
+        os.replace(manifest_path + ".partial", manifest_path)
+
+    def close(self):
+        """Publishes the last, partial batch and removes the scratch directory"""
+        self.publish()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+def read_manifests(destination):
+    """Every archive published to destination by StagedPublishers, as a list of manifest entries
+    ({"archive", "trials", "files"}). Only archives listed here are complete."""
+    entries = []
+    for name in sorted(os.listdir(destination)):
+        if name.startswith("manifest-") and name.endswith(".json"):
+            with open(os.path.join(destination, name)) as manifest_file:
+                entries.extend(json.load(manifest_file)["archives"])
+    return entries
@@ -1,5 +1,9 @@
 import numpy as np
 
+import parallel_update
+from lane_index import LaneIndex
+from periodic_window import window_cells
+
 class Road:
     def __init__(self, length, width, speed_limit, allowed_rows = None):
         self.length = length
@@ -9,10 +13,39 @@ class Road:
         self.allowed_rows = allowed_rows if allowed_rows is not None else []
         self.lane_1_vehicle_occupancy = 0
         self.lane_2_vehicle_occupancy = 0
+        self.lanes = LaneIndex(length) #Vehicles of each row in cyclic order, for gap queries
 
     def is_lane_change_allowed(self, target_row, vehicle_type):
         "Check if the target row is allowed for the vehicle type"
         for row, allowed_type in self.allowed_rows:
             if target_row == row and vehicle_type != allowed_type:
                 return False
-        return True
\ No newline at end of file
+        return True
+
+    def window(self, start, stop, row_start, row_end):
+        "Occupancy of the cells start to stop - 1 along the road (wrapping around the periodic boundary) on rows row_start to row_end - 1"
+        return window_cells(self.occupancy, start, stop)[:, row_start:row_end]
+
+    def occupied_cells_in_window(self, start, stop, row_start, row_end):
+        "Number of occupied cells in a window of the road"
+        return np.count_nonzero(self.window(start, stop, row_start, row_end))
+
+    def is_window_empty(self, start, stop, row_start, row_end):
+        "True if no vehicle covers a window of the road"
+        return not self.window(start, stop, row_start, row_end).any()
+
+    def paint_footprint(self, rear_bumper_position, length, row, width, value):
+        "Write value on the cells covered by a vehicle footprint, wrapping around the periodic boundary"
+        x_start = rear_bumper_position
+        x_end = (rear_bumper_position + length) % self.length
+        y_end = min(row + width, self.width)
+        if x_start < x_end:
+            self.occupancy[x_start:x_end, row:y_end] = value
+        else:
+            self.occupancy[x_start:, row:y_end] = value
+            self.occupancy[:x_end, row:y_end] = value
+
+    def paint_footprints(self, rear_bumper_positions, lengths, rows, widths, values):
+        "Vectorized paint_footprint for many vehicles at once (arrays with one entry per vehicle)"
+        replicas = np.zeros(len(rear_bumper_positions), dtype=np.int64)
+        parallel_update.paint_footprints(self.occupancy[None], replicas, rear_bumper_positions, lengths, rows, widths, values)
@@ -0,0 +1,101 @@
+import heapq
+
+import numpy as np
+
+COST_FIELDS = ("case", "density", "kappa", "arrival_rate", "stop_to_stop_distance")
+
+
+def cost_features(density, kappa, arrival_rate, stop_to_stop_distance):
+    """Regressors of the cost of a timestep: the vehicles (density), the jeepney share among them (kappa) and the
+    passengers spawned per road cell (arrival rate per stop over the stop spacing)"""
+    return [1.0, density, kappa, density * kappa, arrival_rate / stop_to_stop_distance]
+
+
+class CostModel:
+    """Seconds per timestep of one trial of a configuration, learned from past run timings.
+    A configuration that already ran costs the mean of its timings. Otherwise, the cost comes from a least-squares fit of
+    cost_features over every timing, and without enough timings for a fit, from default_seconds_per_step."""
+
+    def __init__(self, default_seconds_per_step):
+        self.default_seconds_per_step = default_seconds_per_step
+        self.observed = {} #Configuration -> (total seconds per step, trials)
+        self.coefficients = None
+        self.floor = default_seconds_per_step
+
+    @classmethod
+    def from_completions(cls, completions, default_seconds_per_step):
+        """Model of the timings logged with the completed trials (see result_store.read_completions)"""
+        model = cls(default_seconds_per_step)
+        model.fit([entry["metadata"] for entry in completions.values() if "seconds" in entry.get("metadata", {})])
+        return model
+
+    def fit(self, timings):
+        """timings: dicts with the COST_FIELDS, the run "seconds" of the trial and its "max_timesteps" """
+        self.observed = {}
+        rows = []
+        costs = []
+        for timing in timings:
+            cost = timing["seconds"] / timing["max_timesteps"]
+            configuration = tuple(timing[field] for field in COST_FIELDS)
+            total, count = self.observed.get(configuration, (0.0, 0))
+            self.observed[configuration] = (total + cost, count + 1)
+            rows.append(cost_features(timing["density"], timing["kappa"], timing["arrival_rate"], timing["stop_to_stop_distance"]))
+            costs.append(cost)
+        self.coefficients = None
+        if not rows:
+            return
+        rows = np.array(rows)
+        self.floor = 0.5 * min(costs) #Keeps extrapolated costs positive
+        if np.linalg.matrix_rank(rows) == rows.shape[1]:
+            self.coefficients = np.linalg.lstsq(rows, np.array(costs), rcond=None)[0]
+
+    def seconds_per_step(self, case, density, kappa, arrival_rate, stop_to_stop_distance):
+        observed = self.observed.get((case, density, kappa, arrival_rate, stop_to_stop_distance))
+        if observed is not None:
+            return observed[0] / observed[1]
+        if self.coefficients is None:
+            return self.default_seconds_per_step
+        return max(self.floor, float(np.dot(self.coefficients, cost_features(density, kappa, arrival_rate, stop_to_stop_distance))))
+
+    def task_seconds(self, task, max_timesteps):
+        """Estimated run time of a sweep task (every trial of it)"""
+        cost = self.seconds_per_step(task.case, task.density, task.kappa, task.arrival_rate, task.stop_to_stop_distance)
+        return cost * max_timesteps * len(task.trials)
+
+
+def longest_first(tasks, costs):
+    """(tasks, costs) ordered by decreasing priority, then decreasing cost (LPT order within a priority)"""
+    order = sorted(range(len(tasks)), key=lambda index: (-tasks[index].priority, -costs[index]))
+    return [tasks[index] for index in order], [costs[index] for index in order]
+
+
+def guided_chunks(tasks, costs, num_cores):
+    """Splits the ordered tasks into chunks of about remaining cost / (2 * num_cores) seconds (at least one task each),
+    so cheap tasks travel to the workers in groups while the chunks shrink towards the end of the sweep.
+    Returns (chunks, chunk costs)."""
+    remaining = sum(costs)
+    chunks = []
+    chunk_costs = []
+    chunk = []
+    chunk_cost = 0.0
+    for task, cost in zip(tasks, costs):
+        if chunk and chunk_cost + cost > remaining / (2 * num_cores):
+            chunks.append(chunk)
+            chunk_costs.append(chunk_cost)
+            remaining -= chunk_cost
+            chunk = []
+            chunk_cost = 0.0
+        chunk.append(task)
+        chunk_cost += cost
+    if chunk:
+        chunks.append(chunk)
+        chunk_costs.append(chunk_cost)
+    return chunks, chunk_costs
+
+
+def makespan(chunk_costs, num_cores):
+    """Wall time of running the chunks in order, each on the first free core"""
+    finish_times = [0.0] * min(num_cores, max(len(chunk_costs), 1))
+    for cost in chunk_costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
@@ -1,5 +1,8 @@
 import numpy as np
 
+from periodic_window import window_cells
+from stop import StopVisibilityTable
+
 class Sidewalk:
     def __init__(self, length, width, max_passengers_per_cell = 5):
         """
@@ -18,7 +21,18 @@ class Sidewalk:
         # Grid to track passenger details (e.g., lists of passengers in each cell)
         self.passengers = [[] for _ in range(length)]
         self.stops = [[] for _ in range(self.length) ] #This should be a list of lists, bcoz we will parametrize this later
+        self.stop_visibility = StopVisibilityTable(self) #Stops seen from each vehicle position, filled as vehicles look them up
         #Track frozen status of sidewalk cells
+
+    def window(self, start, stop):
+        """Occupancy of the sidewalk cells start to stop - 1 (wrapping around the periodic boundary), all rows"""
+        return window_cells(self.occupancy, start, stop)
+
+    def first_occupied_in_window(self, start, stop):
+        """Offset from start of the first sidewalk cell with passengers in the window (None if the window is empty)"""
+        occupied = np.flatnonzero(self.window(start, stop)[:, 0] > 0)
+        return occupied[0] if occupied.size > 0 else None
+
     #     self.frozen_cells = np.zeros(length, dtype=bool) #False by default
 
     # def freeze_cells_for_loading(self, road_positions):
@@ -12,7 +12,7 @@ sidewalk = Sidewalk(length=250, width=1, max_passengers_per_cell=40)
 road_designation = Road(length=250, width=4,speed_limit=5, allowed_rows = allowed_rows_input)
 print(f"The allowed rows for each vehicle are {road_designation.allowed_rows}")
 # Initialize the vehicle simulator (intra-road simulator) with required parameters
-vehicle_simulator = IntraRoadSimulator(road=road_designation)
+vehicle_simulator = IntraRoadSimulator(road=road_designation, seed=None) #Give a seed for a reproducible run, np.random.seed has no effect
 
 # Initialize the pedestrian simulator
 pedestrian_simulator = Passenger_Simulator(
@@ -60,7 +60,7 @@ truck_fraction = 0.2
 # Loop over trials
 for trial in range(1, num_trials + 1):
     # Generate dummy DataFrames (replace with actual simulation data)
-    timestep_summary, passenger_data, vehicle_data, spatio_temporal, sidewalk_patio_temporal = integrated_simulator.run_simulation(
+    timestep_summary, passenger_data, vehicle_data, spatio_temporal, sidewalk_patio_temporal, vehicle_trajectories, stop_queues = integrated_simulator.run_simulation(
         10000, 1, 0.1, 4000, density, truck_fraction, 20, safe_stopping_speed,
         safe_deceleration, jeepney_allowed_rows, truck_allowed_rows, visualize=False
     )
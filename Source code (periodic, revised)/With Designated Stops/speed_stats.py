@@ -0,0 +1,144 @@
+from collections import deque
+
+import numpy as np
+
+
+class SpeedAccumulator:
+    """Running sum and count of speed samples. Gives the mean since the start of the run, the mean of the current step
+    and, with a window, the mean over the last window steps, without storing the samples."""
+
+    def __init__(self, window=None):
+        self.total = 0 #Speeds are integers, so the sums are exact
+        self.count = 0
+        self.step_total = 0
+        self.step_count = 0
+        self.steps = 0 #Number of steps started
+        self.window = window
+        self.previous_steps = deque() #(total, count) of the last window - 1 completed steps
+        self.previous_total = 0
+        self.previous_count = 0
+
+    def start_step(self):
+        """Closes the current step (if any) and starts collecting the samples of a new one"""
+        if self.window is not None and self.steps > 0:
+            self.previous_steps.append((self.step_total, self.step_count))
+            self.previous_total += self.step_total
+            self.previous_count += self.step_count
+            if len(self.previous_steps) >= self.window:
+                oldest_total, oldest_count = self.previous_steps.popleft()
+                self.previous_total -= oldest_total
+                self.previous_count -= oldest_count
+        self.step_total = 0
+        self.step_count = 0
+        self.steps += 1
+
+    def add(self, speeds):
+        """Adds the speeds of several vehicles to the current step"""
+        speeds = np.asarray(speeds)
+        total = int(speeds.sum())
+        self.total += total
+        self.count += speeds.size
+        self.step_total += total
+        self.step_count += speeds.size
+
+    def mean(self):
+        """Mean of every sample since the start of the run (nan without samples, like np.mean of an empty list)"""
+        return self.total / self.count if self.count > 0 else np.nan
+
+    def step_mean(self):
+        """Mean of the samples of the current step"""
+        return self.step_total / self.step_count if self.step_count > 0 else np.nan
+
+    def window_mean(self):
+        """Mean of the samples of the last window steps, the current one included"""
+        if self.window is None:
+            raise ValueError("This accumulator was created without a window")
+        count = self.previous_count + self.step_count
+        return (self.previous_total + self.step_total) / count if count > 0 else np.nan
+
+
+class TemporalSpeedStats:
+    """Online statistics of the speeds of one vehicle across time: count, mean, variance (Welford), min, max and
+    optionally a histogram of the speeds. The full trace is only kept when keep_trace is set."""
+
+    def __init__(self, keep_trace=False, histogram_size=None):
+        self.count = 0
+        self.total = 0 #Exact integer sum, for a mean identical to np.mean of the trace
+        self.running_mean = 0.0
+        self.sum_of_squared_deviations = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(histogram_size, dtype=np.int64) if histogram_size is not None else None
+        self.trace = [] if keep_trace else None
+
+    def add(self, speed):
+        self.count += 1
+        self.total += speed
+        delta = speed - self.running_mean
+        self.running_mean += delta / self.count
+        self.sum_of_squared_deviations += delta * (speed - self.running_mean)
+        self.min = speed if self.min is None else min(self.min, speed)
+        self.max = speed if self.max is None else max(self.max, speed)
+        if self.histogram is not None:
+            self.histogram[speed] += 1
+        if self.trace is not None:
+            self.trace.append(speed)
+
+    def add_counts(self, counts):
+        """Adds counts[speed] samples of each speed at once (see SlotSpeedCounts). Their order is unknown, so the trace
+        cannot be kept; the running mean and variance are combined with the pairwise update of Chan et al."""
+        count = int(counts.sum())
+        if count == 0:
+            return
+        if self.trace is not None:
+            raise ValueError("Speed counts cannot be added to a speed trace")
+        speeds = np.arange(len(counts))
+        total = int(speeds @ counts)
+        mean = total / count
+        delta = mean - self.running_mean
+        new_count = self.count + count
+        self.sum_of_squared_deviations += float(counts @ (speeds - mean) ** 2) + delta * delta * self.count * count / new_count
+        self.running_mean += delta * count / new_count
+        self.count = new_count
+        self.total += total
+        seen = np.flatnonzero(counts)
+        self.min = int(seen[0]) if self.min is None else min(self.min, int(seen[0]))
+        self.max = int(seen[-1]) if self.max is None else max(self.max, int(seen[-1]))
+        if self.histogram is not None:
+            self.histogram += counts
+
+    def mean(self):
+        """Mean speed (nan without samples, like np.mean of an empty list)"""
+        return self.total / self.count if self.count > 0 else np.nan
+
+    def variance(self):
+        """Population variance of the speeds (nan without samples)"""
+        return self.sum_of_squared_deviations / self.count if self.count > 0 else np.nan
+
+
+class SlotSpeedCounts:
+    """Speeds of the vehicles in the slots of a VehicleStateArrays, counted per slot and speed value, so the vectorized
+    update adds the speeds of all the vehicles it moved in one call. Each row goes to the TemporalSpeedStats of its vehicle
+    through TemporalSpeedStats.add_counts."""
+
+    def __init__(self, max_speed):
+        self.counts = np.zeros((0, max_speed + 1), dtype=np.int64)
+
+    def add(self, slots, speeds):
+        """Counts one speed sample for each of the given slots"""
+        if len(slots) == 0:
+            return
+        num_speeds = self.counts.shape[1]
+        if slots.max() >= self.counts.shape[0]:
+            grown = np.zeros((2 * slots.max() + 1, num_speeds), dtype=np.int64)
+            grown[:self.counts.shape[0]] = self.counts
+            self.counts = grown
+        self.counts += np.bincount(slots * num_speeds + speeds, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def take(self, slot):
+        """Counts of a slot, cleared"""
+        if slot >= self.counts.shape[0]:
+            return np.zeros(self.counts.shape[1], dtype=np.int64)
+        counts = self.counts[slot].copy()
+        self.counts[slot] = 0
+        return counts
@@ -6,4 +6,27 @@ class Stop:
         self.unloading_list = []
         self.unloading_dictionary = {}
 
-    
\ No newline at end of file
+    
+class StopVisibilityTable:
+    """Stops seen by a vehicle, keyed by (rear bumper position, number of cells beside the vehicle, look-ahead distance).
+    Stops do not move once generated, so each entry is computed once per run and then shared by every lookup."""
+    def __init__(self, sidewalk):
+        self.sidewalk = sidewalk
+        self.entries = {}
+
+    def clear(self):
+        """Forgets every entry (call after the stops change)"""
+        self.entries = {}
+
+    def lookup(self, rear_bumper_position, adjacent_length, look_ahead_distance):
+        """Returns (stops adjacent, stops ahead, both) with one item per cell, False on cells without a stop"""
+        key = (rear_bumper_position, adjacent_length, look_ahead_distance)
+        if key not in self.entries:
+            length = self.sidewalk.length
+            adjacent = [self.first_stop_at((rear_bumper_position + i) % length) for i in range(adjacent_length)]
+            ahead = [self.first_stop_at((rear_bumper_position + i) % length) for i in range(adjacent_length, adjacent_length + look_ahead_distance)]
+            self.entries[key] = (adjacent, ahead, adjacent + ahead)
+        return self.entries[key]
+
+    def first_stop_at(self, position):
+        return self.sidewalk.stops[position][0] if self.sidewalk.stops[position] else False
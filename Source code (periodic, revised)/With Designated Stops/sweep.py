@@ -0,0 +1,437 @@
+"""Runs a parameter sweep described by a JSON sweep file.
+
+    python sweep.py sweeps/evenly_spaced_stops.json --where case=A --dry-run
+
+The sweep file lists the parameter modules of the cases, the densities, kappas, stop spacings, arrival rates and trials.
+expand_tasks turns it into the task list (one task per trial, or per group of replicas_per_task trials), keeps the
+tasks matching the filters and orders them by priority, then longest first according to the timings of the trials that
+already ran (see scheduling.CostModel). See sweeps/evenly_spaced_stops.json for every key.
+
+Completed trials are logged with the checksums of their files in the results directory (see result_store.CompletionLog).
+A rerun of the same sweep skips them and only runs the trials that are missing or whose files are corrupt (--rerun runs
+everything again). With a cache_directory, the results of every trial are also kept under the digest of their full
+configuration (see result_cache.ResultCache): a trial whose configuration already ran, in this sweep or in another one, is
+read back instead of simulated. A completed trial whose configuration changed since (its case parameter module, the code
+of the model or a sweep setting) is run again. A failing task is reported at the end without stopping the others.
+
+To spread a sweep over several nodes, put its tasks in a work queue on a filesystem shared by the nodes, then start
+workers on every node (see work_queue.WorkQueue):
+
+    python sweep.py sweeps/evenly_spaced_stops.json --queue /shared/queue --enqueue
+    python sweep.py sweeps/evenly_spaced_stops.json --queue /shared/queue --work --cores 30   # on each node
+"""
+import argparse
+import functools
+import importlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import time
+import traceback
+from collections import namedtuple
+from multiprocessing import util
+
+from batch_sim import run_trials
+from random_streams import trial_rng
+from recorders import RecordingPolicy
+from result_store import save_trial, BackgroundWriter, StagedPublisher, CompletionLog, read_completions, verify_completion
+from result_cache import ResultCache, configuration_digest, engine_version, params_version
+from scheduling import CostModel, longest_first, guided_chunks, makespan
+from work_queue import WorkQueue, Heartbeat
+
+SweepTask = namedtuple("SweepTask", ["params_file", "case", "base_arrival_rate", "density", "kappa", "stop_to_stop_distance",
+                                     "arrival_rate", "trials", "priority"])
+
+FILTER_FIELDS = ("case", "base_arrival_rate", "density", "kappa", "stop_to_stop_distance", "arrival_rate", "trial")
+
+DEFAULTS = {
+    "stop_layout": "evenly_spaced",
+    "road_length": 240, "road_width": 4, "speed_limit": 5,
+    "sidewalk_width": 1, "max_passengers_per_cell": 20,
+    "max_timesteps": 10000, "transient_time": 7000,
+    "trials": 50,
+    "seed": 0, #Sweep seed, every trial draws from its own generator derived from it and the trial key (see trial_rng)
+    "update_mode": "sequential", #Vehicle update rule: "sequential" (random sequential) or "parallel" (synchronous), see IntegratedSimulator
+    "replicas_per_task": None, #Trials per task, run as one multi-replica batch (needs the parallel update mode)
+    "where": {}, #Only the tasks whose fields are in these value lists
+    "priorities": [], #[{"where": {...}, "priority": p}], the first matching rule gives the priority of a task (0 otherwise)
+    "seconds_per_step": 0.01, #Cost of one timestep of one trial until timings were logged, see scheduling.CostModel
+    "cores": 30,
+    "recording": {}, #Keyword arguments of RecordingPolicy
+    "output_format": "csv",
+    "results_directory": os.path.join("..", "..", "With Designated Stops Results"), #Relative to the working directory
+    "scratch_directory": None, #Node-local staging directory, see StagedPublisher
+    "publish_batch_size": 50,
+    "max_pending_writes": 2, #See BackgroundWriter, None saves synchronously
+    "heartbeat_seconds": 30, #Work queue heartbeat of the running tasks
+    "stale_seconds": 300, #A running task without heartbeat for this long is requeued
+    "cache_directory": None, #Opt-in content-addressed result cache shared by sweeps (a second copy of every trial), see result_cache.ResultCache
+}
+
+STOP_LAYOUTS = ("evenly_spaced",)
+UPDATE_MODES = ("sequential", "parallel")
+
+
+def get_per_stop_arrival_rates(road_length, base_stop_spacing, base_arrival_rate, stop_spacings, verbose=True):
+    """Compute passenger arrival rates per stop spacing (same total arrival rate along the road for every spacing)."""
+    num_base_stops = road_length // base_stop_spacing
+    total_arrival_rate = num_base_stops * base_arrival_rate
+    results = []
+
+    for spacing in stop_spacings:
+        num_stops = road_length // spacing
+        if num_stops == 0:
+            continue
+        arrival_rate_per_stop = total_arrival_rate / num_stops
+        results.append((spacing, round(arrival_rate_per_stop, 4)))
+
+    return results
+
+
+def load_sweep(path):
+    """Reads a sweep file and fills in the defaults"""
+    with open(path) as sweep_file:
+        sweep = dict(DEFAULTS, **json.load(sweep_file))
+    check_sweep(sweep)
+    return sweep
+
+
+def check_sweep(sweep):
+    """Raises ValueError for inconsistent sweep settings"""
+    if sweep["stop_layout"] not in STOP_LAYOUTS:
+        raise ValueError(f"Unknown stop layout: {sweep['stop_layout']} (this model has {', '.join(STOP_LAYOUTS)} stops)")
+    unknown = set(sweep["where"]) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {sorted(unknown)}")
+    if sweep["update_mode"] not in UPDATE_MODES:
+        raise ValueError(f"Unknown update mode: {sweep['update_mode']}")
+    if (sweep["replicas_per_task"] or 1) > 1 and sweep["update_mode"] != "parallel":
+        raise ValueError("Multi-replica tasks (replicas_per_task > 1) run the parallel update rule, set \"update_mode\": \"parallel\" "
+                         "to use them (the update rule changes the model, batching alone must not)")
+
+
+def arrival_rate_tables(sweep):
+    """[(base arrival rate, [(stop spacing, arrival rate per stop), ...]), ...] of the sweep. "arrival_rates" is either a list of
+    per-stop rates used with every spacing, or {"base_stop_spacing": s, "base_rates": [...]} to keep the total rate of each base rate"""
+    arrival_rates = sweep["arrival_rates"]
+    if isinstance(arrival_rates, dict):
+        return [(base_rate, get_per_stop_arrival_rates(sweep["road_length"], arrival_rates["base_stop_spacing"], base_rate, sweep["stop_spacings"]))
+                for base_rate in arrival_rates["base_rates"]]
+    return [(rate, [(spacing, rate) for spacing in sweep["stop_spacings"]]) for rate in arrival_rates]
+
+
+def matches(fields, where):
+    return all(fields[key] in values for key, values in where.items())
+
+
+def expand_tasks(sweep, where=None):
+    """Task list of a sweep, restricted to the tasks matching the sweep's and the given filters, highest priority first.
+    Trials the recording policy records nothing of (see RecordingPolicy.trials) are left out."""
+    check_sweep(sweep)
+    filters = [sweep["where"]] + ([where] if where else [])
+    trials = sweep["trials"]
+    trials = list(range(1, trials + 1)) if isinstance(trials, int) else list(trials)
+    policy = RecordingPolicy(**sweep["recording"])
+    trials = [trial for trial in trials if policy.for_trial(trial).outputs]
+    group_size = sweep["replicas_per_task"] or 1
+    tasks = []
+    for params_file in sweep["cases"]:
+        case = importlib.import_module(params_file).case
+        for base_arrival_rate, stop_arrival_table in arrival_rate_tables(sweep):
+            for density, kappa, (stop_to_stop_distance, arrival_rate) in itertools.product(sweep["densities"], sweep["kappas"], stop_arrival_table):
+                fields = {"case": case, "base_arrival_rate": base_arrival_rate, "density": density, "kappa": kappa,
+                          "stop_to_stop_distance": stop_to_stop_distance, "arrival_rate": arrival_rate}
+                selected = [trial for trial in trials if all(matches(dict(fields, trial=trial), where) for where in filters)]
+                if not selected:
+                    continue
+                priority = next((rule["priority"] for rule in sweep["priorities"] if matches(dict(fields, trial=selected[0]), rule["where"])), 0)
+                for first in range(0, len(selected), group_size):
+                    tasks.append(SweepTask(params_file, case, base_arrival_rate, density, kappa, stop_to_stop_distance, arrival_rate,
+                                           tuple(selected[first:first + group_size]), priority))
+    tasks.sort(key=lambda task: -task.priority) #Stable, tasks of equal priority keep the sweep order
+    return tasks
+
+
+def trial_key(task, trial):
+    """Key of one trial of a sweep in the completion log"""
+    return (task.case, task.density, task.kappa, task.arrival_rate, task.stop_to_stop_distance, trial)
+
+
+def trial_configuration(sweep, task, trial):
+    """Every input deciding the results of a trial, including the versions of its case parameter module and of the model code"""
+    configuration = {key: sweep[key] for key in ("stop_layout", "road_length", "road_width", "speed_limit", "sidewalk_width",
+                                                 "max_passengers_per_cell", "max_timesteps", "transient_time", "recording", "seed")}
+    configuration.update(task._asdict(), trial=trial, params=params_version(task.params_file), engine=engine_version(),
+                         update_mode=sweep["update_mode"])
+    for field in ("base_arrival_rate", "trials", "priority"): #The per-stop arrival rate is what the model sees
+        del configuration[field]
+    return configuration
+
+
+def trial_digest(sweep, task, trial):
+    return configuration_digest(trial_configuration(sweep, task, trial))
+
+
+def pending_tasks(sweep, tasks, verify=True):
+    """The tasks restricted to the trials without a (valid, when verifying the checksums) completion entry in the results
+    directory for their current configuration, tasks without such trials dropped.
+    Returns (tasks, completed trial count, corrupt trial count)."""
+    directory = os.path.abspath(sweep["results_directory"])
+    completions = read_completions(directory)
+    pending = []
+    completed = corrupt = 0
+    for task in tasks:
+        trials = []
+        for trial in task.trials:
+            entry = completions.get(trial_key(task, trial))
+            if entry is not None and entry.get("metadata", {}).get("digest") not in (None, trial_digest(sweep, task, trial)):
+                entry = None #Completed with another configuration
+            if entry is None:
+                trials.append(trial)
+            elif verify and not verify_completion(directory, entry):
+                corrupt += 1
+                trials.append(trial)
+            else:
+                completed += 1
+        if trials:
+            pending.append(task._replace(trials=tuple(trials)))
+    return pending, completed, corrupt
+
+
+def plan_tasks(sweep, tasks):
+    """The tasks in longest-processing-time-first order within each priority, with their estimated run times in seconds"""
+    model = CostModel.from_completions(read_completions(os.path.abspath(sweep["results_directory"])), sweep["seconds_per_step"])
+    return longest_first(tasks, [model.task_seconds(task, sweep["max_timesteps"]) for task in tasks])
+
+
+worker_sweep = None #Sweep being run by this pool worker, set by start_worker
+background_writer = None #BackgroundWriter of this pool worker
+publisher = None #StagedPublisher of this pool worker, when staging
+completion_log = None #CompletionLog of this pool worker
+result_cache = None #ResultCache of this pool worker, when caching
+
+
+def start_worker(sweep):
+    """Pool worker initializer: keeps the sweep settings and starts the worker's background writer and publisher, which
+    finish their pending saves and publish the last batch when the worker exits."""
+    global worker_sweep, background_writer, publisher, completion_log, result_cache
+    worker_sweep = sweep
+    background_writer = publisher = None
+    completion_log = CompletionLog(os.path.abspath(sweep["results_directory"]))
+    result_cache = ResultCache(os.path.abspath(sweep["cache_directory"])) if sweep["cache_directory"] is not None else None
+    if sweep["scratch_directory"] is not None:
+        publisher = StagedPublisher(sweep["scratch_directory"], os.path.abspath(sweep["results_directory"]), sweep["publish_batch_size"], completion_log)
+        util.Finalize(None, publisher.close, exitpriority=5) #After the background writer
+    if sweep["max_pending_writes"] is not None:
+        background_writer = BackgroundWriter(sweep["max_pending_writes"])
+        util.Finalize(None, background_writer.close, exitpriority=10)
+
+
+def run_task(task):
+    """Runs the trials of a task (see batch_sim.run_trials) and saves their results. The trials found in the result cache are read back instead."""
+    sweep = worker_sweep
+    digests = {trial: trial_digest(sweep, task, trial) for trial in task.trials}
+    cached = {}
+    if result_cache is not None:
+        for trial in task.trials:
+            hit = result_cache.get(digests[trial])
+            if hit is not None:
+                cached[trial] = hit
+    for trial, (results, metadata) in cached.items():
+        save_results(sweep, task, trial, results, metadata.get("seconds"), digests[trial], cached=True)
+    trials = [trial for trial in task.trials if trial not in cached]
+    if not trials:
+        return
+    start = time.perf_counter()
+    params = importlib.import_module(task.params_file)
+    policy = RecordingPolicy(**sweep["recording"])
+    batch_results = run_trials(
+        params, [trial_rng(sweep["seed"], *trial_key(task, trial)) for trial in trials], [policy.for_trial(trial) for trial in trials],
+        sweep["update_mode"], sweep["road_length"], sweep["road_width"], sweep["speed_limit"], sweep["sidewalk_width"],
+        sweep["max_passengers_per_cell"], task.arrival_rate, sweep["max_timesteps"], sweep["transient_time"], task.density, task.kappa,
+        task.stop_to_stop_distance)
+    seconds = (time.perf_counter() - start) / len(trials)
+    for trial, results in zip(trials, batch_results):
+        save_results(sweep, task, trial, results, seconds, digests[trial])
+
+
+def save_results(sweep, task, trial, results, seconds=None, digest=None, cached=False):
+    """Saves the result tables of one trial in the sweep's output format (tables that were not recorded are None and skipped),
+    and in the result cache when they were just computed"""
+    stop_folder = f"Case_{task.case}_StopToStop_{task.stop_to_stop_distance}_Evenly_Spaced_Stops"
+    arrival_folder = os.path.join(stop_folder, f"Kappa_{task.kappa}", f"Density_{task.density}", f"PassengerRate_{task.arrival_rate:.3f}")
+    filename = f"Trial_{trial}_D{task.density}_K{task.kappa}_R{task.arrival_rate}_S{task.stop_to_stop_distance}"
+    metadata = {"trial": trial, "density": task.density, "kappa": task.kappa, "stop_to_stop_distance": task.stop_to_stop_distance,
+                "arrival_rate": task.arrival_rate, "case": task.case, "max_timesteps": sweep["max_timesteps"], "transient_time": sweep["transient_time"],
+                "seed": sweep["seed"],
+                "seconds": seconds, #Run time of the trial, for the cost model
+                "digest": digest}
+    key = trial_key(task, trial)
+    if publisher is not None: #Staged paths are relative to the results folder, the trial is logged when published
+        save = publisher.save_trial
+    else:
+        save = save_and_log
+        arrival_folder = os.path.join(os.path.abspath(sweep["results_directory"]), arrival_folder)
+    if result_cache is not None and not cached:
+        save = functools.partial(cache_and_save, save, digest)
+    if background_writer is not None:
+        background_writer.submit(save, results, arrival_folder, filename, sweep["output_format"], metadata, key=key)
+    else:
+        save(results, arrival_folder, filename, sweep["output_format"], metadata, key=key)
+
+
+def cache_and_save(save, digest, results, directory, filename, output_format, metadata, key):
+    """Stores the results in the result cache, then saves them with save"""
+    result_cache.put(digest, results, metadata)
+    return save(results, directory, filename, output_format, metadata, key=key)
+
+
+def save_and_log(results, directory, filename, output_format, metadata, key):
+    """save_trial, then logs the trial as completed with the checksums of its files"""
+    paths = save_trial(results, directory, filename, output_format, metadata)
+    completion_log.record_paths(key, paths, metadata)
+    return paths
+
+
+def run_and_report(task):
+    """run_task, returning (task, None) on success and (task, formatted traceback) on an error instead of raising it"""
+    try:
+        run_task(task)
+    except Exception:
+        return task, traceback.format_exc()
+    return task, None
+
+
+def run_chunk(chunk):
+    return [run_and_report(task) for task in chunk]
+
+
+def run_tasks(sweep, tasks, num_cores, verbose=True, costs=None):
+    """Runs the tasks on a worker pool, longest first (see plan_tasks, or in the given order with their given costs) and in
+    guided chunks, collecting them as they finish so that a failing task does not stop the others.
+    The pool is closed and joined rather than terminated, so every worker finishes its background saves and publishes its
+    staged results. Returns the failed tasks as (task, traceback) pairs."""
+    if costs is None:
+        tasks, costs = plan_tasks(sweep, tasks)
+    failures = []
+    done = 0
+    with mp.Pool(num_cores, initializer=start_worker, initargs=(sweep,)) as pool:
+        for reports in pool.imap_unordered(run_chunk, guided_chunks(tasks, costs, num_cores)[0]):
+            for task, error in reports:
+                done += 1
+                if error is not None:
+                    failures.append((task, error))
+                    if verbose:
+                        print(f"Task failed: {task}\n{error}")
+                if verbose and done % 100 == 0:
+                    print(f"{done}/{len(tasks)} tasks done, {len(failures)} failed")
+        pool.close()
+        pool.join()
+    return failures
+
+
+def run_queue_worker(sweep, directory):
+    """Worker process of a work queue: claims and runs tasks, heartbeating the running one, and requeues the tasks of
+    dead workers, until no task is pending or running. A task is done once its trials ran and their saves were handed to
+    the background writer or publisher: the completion log stays the record of the saved trials."""
+    start_worker(sweep)
+    work_queue = WorkQueue(directory, sweep["heartbeat_seconds"], sweep["stale_seconds"])
+    try:
+        while True:
+            work_queue.requeue_stale()
+            claimed = work_queue.claim()
+            if claimed is None:
+                if not work_queue.names("running"):
+                    return
+                time.sleep(work_queue.heartbeat_seconds) #Tasks still running elsewhere may come back if their worker dies
+                continue
+            claim_name, fields = claimed
+            heartbeat = Heartbeat(work_queue, claim_name)
+            try:
+                task, error = run_and_report(SweepTask(**dict(fields, trials=tuple(fields["trials"]))))
+            finally:
+                heartbeat.stop()
+            work_queue.finish(claim_name, error)
+    finally:
+        work_queue.close()
+
+
+def run_queue_workers(sweep, directory, num_processes):
+    """Runs num_processes work queue workers on this node until the queue is drained. Returns the failed tasks of the
+    queue as (task file, traceback file) pairs."""
+    workers = [mp.Process(target=run_queue_worker, args=(sweep, directory), name=f"queue-worker-{index}") for index in range(num_processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = os.path.join(directory, "failed")
+    return [(os.path.join(failed, name), os.path.join(failed, name[:-len(".json")] + ".txt")) for name in WorkQueue(directory).names("failed")]
+
+
+def parse_where(expressions):
+    """--where field=value1,value2 filters (numbers are compared as numbers, case as text)"""
+    where = {}
+    for expression in expressions:
+        field, _, values = expression.partition("=")
+        if field not in FILTER_FIELDS or not values:
+            raise ValueError(f"Filters look like field=value1,value2 with field one of {', '.join(FILTER_FIELDS)}, got {expression}")
+        where[field] = [value if field == "case" else json.loads(value) for value in values.split(",")]
+    return where
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a parameter sweep described by a sweep file.")
+    parser.add_argument("sweep_file")
+    parser.add_argument("--where", action="append", default=[], metavar="FIELD=VALUES", help=f"Only run the tasks whose field is one of the values ({', '.join(FILTER_FIELDS)})")
+    parser.add_argument("--cores", type=int, help="Worker processes (default: the sweep file's cores, at most the CPU count)")
+    parser.add_argument("--replicas-per-task", type=int, help="Trials per multi-replica task (parallel update mode only)")
+    parser.add_argument("--dry-run", action="store_true", help="Report the task count and the estimated core-hours without running")
+    parser.add_argument("--rerun", action="store_true", help="Run the completed trials again")
+    parser.add_argument("--no-verify", action="store_true", help="Trust the completion log without checking the checksums of the files")
+    parser.add_argument("--queue", metavar="DIRECTORY", help="Work queue directory on a filesystem shared by the nodes")
+    parser.add_argument("--enqueue", action="store_true", help="Put the tasks in the work queue instead of running them")
+    parser.add_argument("--work", action="store_true", help="Run work queue workers on this node until the queue is drained")
+    args = parser.parse_args(argv)
+    if (args.enqueue or args.work) != (args.queue is not None):
+        parser.error("--queue goes with --enqueue and/or --work")
+
+    sweep = load_sweep(args.sweep_file)
+    if args.replicas_per_task is not None:
+        sweep["replicas_per_task"] = args.replicas_per_task
+    num_cores = min(mp.cpu_count(), args.cores or sweep["cores"])
+    if args.work and not args.enqueue:
+        return [], report_failures(run_queue_workers(sweep, args.queue, num_cores))
+    tasks = expand_tasks(sweep, parse_where(args.where))
+    if not args.rerun:
+        tasks, completed, corrupt = pending_tasks(sweep, tasks, verify=not args.no_verify)
+        print(f"{completed} trials already completed, {corrupt} with missing or corrupt files to run again")
+    tasks, costs = plan_tasks(sweep, tasks)
+    core_hours = sum(costs) / 3600
+    hours = makespan(guided_chunks(tasks, costs, num_cores)[1], num_cores) / 3600
+    print(f"{len(tasks)} tasks, {sum(len(task.trials) for task in tasks)} trials, about {core_hours:.1f} core-hours, "
+          f"{hours:.1f} h on {num_cores} cores ({core_hours / num_cores:.1f} h with a perfect balance)")
+    if args.dry_run:
+        return tasks, []
+    if args.enqueue:
+        WorkQueue(args.queue).enqueue([task._asdict() for task in tasks]) #Claimed in the longest first order
+        print(f"{len(tasks)} tasks queued in {args.queue}")
+        if not args.work:
+            return tasks, []
+        return tasks, report_failures(run_queue_workers(sweep, args.queue, num_cores))
+    return tasks, report_failures(run_tasks(sweep, tasks, num_cores, costs=costs))
+
+
+def report_failures(failures):
+    if failures:
+        print(f"{len(failures)} tasks failed, run the sweep again to retry them")
+    return failures
+
+
+if __name__ == "__main__":
+    try:
+        mp.set_start_method("fork", force=True)
+    except RuntimeError:
+        pass
+    tasks, failures = main()
+    raise SystemExit(1 if failures else 0)
@@ -1,16 +1,17 @@
 import numpy as np
 from math import inf
 
+from speed_stats import TemporalSpeedStats
+
 class Vehicle:
-    _id_counter = 0
     """Define vehicle attributes and rules of movement"""
-    def __init__(self, rear_bumper_position, speed, max_speed, length, width, road_designation, vehicle_type, current_row, lane_change_prob, sidewalk, safe_stopping_speed, safe_deceleration):
-        self.vehicle_id = Vehicle._id_counter
-        Vehicle._id_counter += 1 #increment vehicle ID based on order of initialization
+    def __init__(self, rear_bumper_position, speed, max_speed, length, width, road_designation, vehicle_type, current_row, lane_change_prob, sidewalk, safe_stopping_speed, safe_deceleration, rng, vehicle_id):
+        self.vehicle_id = vehicle_id #identifying number, allocated by the vehicle simulator in order of initialization
         self.rear_bumper_position = rear_bumper_position #rear_bumper_position along the length of the road (x rear_bumper_position)
         self.speed = speed #number of cells the vehicle will move per timestep
         self.max_speed = max_speed #maximum speed
         self.braking_prob = 0.01 #probability of random slowdown
+        self.rng = rng #Random number generator of the run, the one of the vehicle simulator
         self.length = length #length of the vehicle is the number of cells the vehicle occupies along the length of the road
         self.width = width #width of the vehicle is the number of cells the vehicle occupies along the width of the road
         self.road_designation = road_designation 
@@ -36,7 +37,7 @@ class Vehicle:
         self.at_the_edge = False
         self.matching_stop_found = False 
         self.overshot_destination = False
-        self.temporal_speeds = []
+        self.temporal_speed_stats = TemporalSpeedStats() #Speeds after the transient, see IntraRoadSimulator for the trace and histogram options
         self.mean_temporal_speed = None
         self.allow_loading = None
         self.starting_rear_bumper_position = None #To keep track on the position where the vehicle is when we started collecting data
@@ -56,6 +57,11 @@ class Vehicle:
         self.previous_speed = None
         self.previous_front_bumper_position = None
         self.passengers_on_board = {} #Dictionary for unloading purposes
+        self.occupancy_code = 1 if self.vehicle_type == "jeep" else 2 #Value painted on the road occupancy grid
+        self.painted_footprint = None #(rear bumper position, row) currently painted on the road occupancy grid
+        self.lane_row = None #Row of the lane ring (see LaneIndex) the vehicle is registered in
+        self.leader = None #Next vehicle ahead on the same row
+        self.follower = None #Next vehicle behind on the same row
         # self.active_loading_list = []
         # self.queue_loading_list = []
 
@@ -67,25 +73,12 @@ class Vehicle:
             # print(f"{self.vehicle_type} {self.vehicle_id} accelerated to a speed of {self.speed}")
 
     def gap_distance(self, vehicle_row_to_be_checked):  #This is responsible for VEHICLE gap distance
-        """Debugging this - make gap distance consider toroidal boundary cond. recently introduced"""
-        """vehicle row to be checked: Input is row 0, you check for lane 1(row 0 and 1). Input is row 1, you check for lane at the middle (row 1 and 2). Input is row 2, you check for lane 2(rows 2 and 3)."""
+        """vehicle row to be checked: Input is row 0, you check for lane 1(row 0 and 1). Input is row 1, you check for lane at the middle (row 1 and 2). Input is row 2, you check for lane 2(rows 2 and 3). The leading vehicles are found through the lane index of the road, so the cost does not grow with the look-ahead distance"""
         look_ahead_distance = self.speed #With t=1
-        #print(f"{self.vehicle_type} {self.vehicle_id}'s maximum distance is  {look_ahead_distance}")
-        gap_distance = look_ahead_distance
-        
-        for distance in range(1, look_ahead_distance + 1):
-            start_of_space_to_be_checked = (self.rear_bumper_position + self.length + distance - 1)  % self.road_designation.length #putting the modulo operator here removes the need for separate considerations under periodic boundary conditions
-            #print(f"{self.vehicle_type} {self.vehicle_id}: next rear bumper rear_bumper_position is {start_of_space_to_be_checked}")
-            if np.sum(self.road_designation.occupancy[start_of_space_to_be_checked, vehicle_row_to_be_checked:vehicle_row_to_be_checked + self.width]) != 0:
-                gap_distance = distance - 1 #When the vehicle is detected, that distance is already occupied, so we subtract 1 to be accurate
-                #print(np.sum(self.road_designation.road_occupancy[start_of_space_to_be_checked, vehicle_row_to_be_checked:vehicle_row_to_be_checked + self.width]))
-                break
-        if gap_distance < 0: #For debugging
-            pass
-            print(f"Error, {self.vehicle_type} {self.vehicle_id} negative gap distance of {gap_distance}, at rear bumper rear_bumper_position {self.rear_bumper_position}") 
-        else:
-            pass
-            #print(f"Vehicle {self.vehicle_id}'s gap distance from the leading vehicle is {gap_distance}")
+        first_cell_ahead = (self.rear_bumper_position + self.length) % self.road_designation.length #putting the modulo operator here removes the need for separate considerations under periodic boundary conditions
+        distance_to_leading_vehicle = self.road_designation.lanes.distance_ahead(self, vehicle_row_to_be_checked, self.width, first_cell_ahead)
+        gap_distance = min(look_ahead_distance, distance_to_leading_vehicle)
+        #print(f"Vehicle {self.vehicle_id}'s gap distance from the leading vehicle is {gap_distance}")
         return gap_distance # Return the  gap distance
 
 
@@ -93,10 +86,8 @@ class Vehicle:
         """This method checks for the adjacent lane: if determines if the cells adjacent to the vehicle are empty and the cells within its look ahead distance"""
         #print(f"{self.vehicle_type} {self.vehicle_id} checks the availability of lane {target_row/2}")
         look_ahead_distance = self.speed #Assuming t = 1
-        rolled_occupancy = np.roll(self.road_designation.occupancy, -self.rear_bumper_position, axis = 0)
-        #print(f"{self.vehicle_type} {self.vehicle_id} checks the availability of lane {target_row/2}: {np.sum(rolled_occupancy[0:self.length + look_ahead_distance + 1, target_row])}")
-        #print(f"{self.vehicle_type} {self.vehicle_id} checks {rolled_occupancy[0: look_ahead_distance + 1, target_row].T}")
-        return np.sum(rolled_occupancy[0: self.length + look_ahead_distance + 1, target_row]) #Feb 23 - included length
+        #print(f"{self.vehicle_type} {self.vehicle_id} checks the availability of lane {target_row/2}: {self.road_designation.window(self.rear_bumper_position, self.rear_bumper_position + self.length + look_ahead_distance + 1, target_row, target_row + 1).T}")
+        return self.road_designation.occupied_cells_in_window(self.rear_bumper_position, self.rear_bumper_position + self.length + look_ahead_distance + 1, target_row, target_row + 1) #Feb 23 - included length
 
     def begin_straddling(self, direction):
         """This method executes the actual action of changing lanes (in particular, this methods let the vehicle begin straddling)
@@ -107,9 +98,7 @@ class Vehicle:
             self.accelerate()
             #print(f"{self.vehicle_type} {self.vehicle_id} accelerates to possibly lane change. ")
 
-        rolled_occupancy = np.roll(self.road_designation.occupancy, -self.front_bumper_position, axis = 0)
-
-        if self.speed > 0 and np.all(rolled_occupancy[1:self.speed + 1, self.current_row])== 0: #Check on the current lane
+        if self.speed > 0 and np.all(self.road_designation.window(self.front_bumper_position + 1, self.front_bumper_position + self.speed + 1, self.current_row, self.current_row + 1))== 0: #Check on the current lane
             self.current_row += direction
             self.move()
             if self.current_row == 1:
@@ -130,39 +119,23 @@ class Vehicle:
         return True
 
     def detect_stops_adjacent_and_ahead(self):
+        """Stops beside the vehicle (its occupied positions) and within its look-ahead distance, read from the stop visibility table of the sidewalk"""
         if self.vehicle_type == "jeep":
-            self.stop_list_adjacent = []
-            self.stop_list_ahead = []
-            self.stop_list_adjacent_and_ahead = []
-            current_positions = self.pool_of_occupied_positions
-            future_positions = [(self.rear_bumper_position + i) % self.road_designation.length for i in range(self.length, self.length + self.look_ahead_distance)]
-            for position in current_positions:
-                if self.sidewalk.stops[position]:  # Ensure it's not empty
-                    stop_checked = self.sidewalk.stops[position][0]  # Peek instead of pop
-                    self.stop_list_adjacent.append(stop_checked)
-                else:
-                    self.stop_list_adjacent.append(False)  # Indicate no stop found
-            for position in future_positions:
-                if self.sidewalk.stops[position]:  # Ensure it's not empty
-                    stop_checked = self.sidewalk.stops[position][0]  # Peek instead of pop
-                    self.stop_list_ahead.append(stop_checked)
-                else:
-                    self.stop_list_ahead.append(False)  # Indicate no stop found
+            self.stop_list_adjacent, self.stop_list_ahead, self.stop_list_adjacent_and_ahead = self.sidewalk.stop_visibility.lookup(
+                self.rear_bumper_position, len(self.pool_of_occupied_positions), self.look_ahead_distance)
         #print(f"The stop positions are {[stop.position for stop in (self.stop_list_adjacent + self.stop_list_ahead) if stop]}")
 
 
     def detect_passengers_adjacent_and_ahead(self):
         """Detects if there are passengers on stops ahead on the sidewalk."""
         if self.vehicle_type == "jeep":
-            rolled_sidewalk = np.roll(self.sidewalk.occupancy, -self.rear_bumper_position)
-            return np.any(rolled_sidewalk[:self.length + self.look_ahead_distance])
+            return np.any(self.sidewalk.window(self.rear_bumper_position, self.rear_bumper_position + self.length + self.look_ahead_distance))
         return False  # Default return for non-jeep vehicles
 
     def will_unload_passengers(self):
         """Determines if any passenger within the vehicle wants to get off."""
         self.detect_stops_adjacent_and_ahead()
         
-        self.stop_list_adjacent_and_ahead = self.stop_list_adjacent+self.stop_list_ahead
         for passenger in self.passengers_within_vehicle:
             passenger.determine_if_let_me_out(self)
             passenger.determine_if_overshot_destination(self)
@@ -268,15 +241,14 @@ class Vehicle:
 
             if target_row is not None:
                 self.front_bumper_position = self.rear_bumper_position + self.length - 1
-                shifted_occupancy = np.roll(self.road_designation.occupancy, -(self.front_bumper_position + 1), axis = 0)
-                # print(f"{self.vehicle_type} {self.vehicle_id}'s space ahead is {shifted_occupancy}, the front bumper is at {self.front_bumper_position}'")
+                first_cell_ahead = self.front_bumper_position + 1
                 
                 if self.speed > 0:
-                    space_available = np.sum(shifted_occupancy[0:look_ahead_distance+1, self.current_row:self.current_row + self.width]) == 0
-                    # print(f"{self.vehicle_type} {self.vehicle_id}'s space checked is {shifted_occupancy[0:look_ahead_distance+1, self.current_row:self.current_row + self.width].T}'")
+                    space_available = self.road_designation.is_window_empty(first_cell_ahead, first_cell_ahead + look_ahead_distance + 1, self.current_row, self.current_row + self.width)
+                    # print(f"{self.vehicle_type} {self.vehicle_id}'s space checked is {self.road_designation.window(first_cell_ahead, first_cell_ahead + look_ahead_distance + 1, self.current_row, self.current_row + self.width).T}'")
                 elif self.speed == 0:
-                    space_available = np.sum(shifted_occupancy[0:2, self.current_row:self.current_row + self.width])== 0 #Check at least 2 cells in front
-                    # print(f"{self.vehicle_type} {self.vehicle_id}'s space checked is {shifted_occupancy[0:2, self.current_row:self.current_row + self.width].T}'")
+                    space_available = self.road_designation.is_window_empty(first_cell_ahead, first_cell_ahead + 2, self.current_row, self.current_row + self.width) #Check at least 2 cells in front
+                    # print(f"{self.vehicle_type} {self.vehicle_id}'s space checked is {self.road_designation.window(first_cell_ahead, first_cell_ahead + 2, self.current_row, self.current_row + self.width).T}'")
                 
                 if space_available:
                     # print(f"{self.vehicle_type} {self.vehicle_id}'s empty space ahead is {shifted_occupancy}'")
@@ -300,18 +272,15 @@ class Vehicle:
         """Determines the distance to the nearest pedestrian ahead of the jeepney."""
         look_ahead_distance = self.speed  # Assuming t = 1
         rear_bumper = self.rear_bumper_position
-        # Shift the sidewalk occupancy array so the rear bumper is at index 0
-        rolled_sidewalk = np.roll(self.sidewalk.occupancy[:, 0], -rear_bumper)
-        # print(f"{self.vehicle_type} {self.vehicle_id}'s rolled sidewalk is {rolled_sidewalk}.")
         # Check if any pedestrian is directly adjacent to the jeepney
-        if np.any(rolled_sidewalk[:self.length] > 0):
+        if self.sidewalk.first_occupied_in_window(rear_bumper, rear_bumper + self.length) is not None:
             # print(f"A passenger is directly adjacent to {self.vehicle_type} {self.vehicle_id}.")
-            # print(f"{self.vehicle_type} {self.vehicle_id}'s adjacent sidewalk is {rolled_sidewalk[:self.length]}.")
+            # print(f"{self.vehicle_type} {self.vehicle_id}'s adjacent sidewalk is {self.sidewalk.window(rear_bumper, rear_bumper + self.length).T}.")
             return 0  # Passenger is directly adjacent
         # Look for the first pedestrian within the look-ahead distance **starting from the front bumper**
-        pedestrian_headway_list = np.where(rolled_sidewalk[self.length : self.length + look_ahead_distance] > 0)[0]
+        first_pedestrian_ahead = self.sidewalk.first_occupied_in_window(rear_bumper + self.length, rear_bumper + self.length + look_ahead_distance)
         # The first index represents the correct distance from the **front bumper**.
-        pedestrian_headway = pedestrian_headway_list[0] + 1 if pedestrian_headway_list.size > 0 else look_ahead_distance
+        pedestrian_headway = first_pedestrian_ahead + 1 if first_pedestrian_ahead is not None else look_ahead_distance
         # print(f"{self.vehicle_type} {self.vehicle_id} has pedestrian headway: {pedestrian_headway}")
         return pedestrian_headway
 
@@ -618,7 +587,7 @@ class Vehicle:
     def random_slowdown(self):
         """Mimics random slowdown, randomly decreases vehicle's speed based on braking probability """
         # print(f"{self.vehicle_type} {self.vehicle_id} is calling random slowdown method")
-        if np.random.rand() < self.braking_prob and self.speed > 0:
+        if self.rng.random() < self.braking_prob and self.speed > 0:
             self.speed -= 1
         return
 
@@ -639,12 +608,18 @@ class Vehicle:
 
     def move(self):
         """Implements longitudinal translation of the vehicle"""
-        self.previous_stop_list_ahead = self.stop_list_ahead
-        self.previous_stop_list_adjacent = self.stop_list_adjacent
-        self.previous_front_bumper_position = self.front_bumper_position
         new_position = (self.rear_bumper_position + self.speed) % self.road_designation.length
         self.previous_rear_bumper_position = self.rear_bumper_position #store the previous rear_bumper_position before updating
         self.rear_bumper_position = new_position #This will be the "current" rear_bumper_position
+        self.after_move()
+        self.update_footprint()
+
+    def after_move(self):
+        """Updates everything that follows from a new rear bumper position (also used after a vectorized move of the state arrays)"""
+        self.previous_stop_list_ahead = self.stop_list_ahead
+        self.previous_stop_list_adjacent = self.stop_list_adjacent
+        self.previous_front_bumper_position = self.front_bumper_position
+        new_position = self.rear_bumper_position
         self.front_bumper_position = new_position + self.length - 1
         self.next_rear_bumper_position = new_position + self.speed
         self.next_front_bumper_position = self.next_rear_bumper_position + self.length - 1
@@ -652,4 +627,14 @@ class Vehicle:
         self.determine_cross_edge()
         # self.determine_if_about_to_cross_edge()
         self.update_pool_of_occupied_positions()
-        self.passengers_served = 0
\ No newline at end of file
+        self.passengers_served = 0
+
+    def update_footprint(self):
+        """Erases the footprint previously painted on the road occupancy and paints the current one (O(length) instead of repainting the whole road)"""
+        if self.painted_footprint is not None:
+            painted_rear, painted_row = self.painted_footprint
+            self.road_designation.paint_footprint(painted_rear, self.length, painted_row, self.width, 0)
+        self.road_designation.paint_footprint(self.rear_bumper_position, self.length, self.current_row, self.width, self.occupancy_code)
+        self.painted_footprint = (self.rear_bumper_position, self.current_row)
+        self.road_designation.lanes.update(self) #Only changes the lane rings when the row changed
+        return
\ No newline at end of file
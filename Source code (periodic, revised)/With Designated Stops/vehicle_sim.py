@@ -3,15 +3,33 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 
 from vehicle import Vehicle
+from vehicle_state import VehicleStateArrays, VehicleStateBatch, ArrayBackedVehicle
+import parallel_update
 from road import Road
 from counter import Counter
+from speed_stats import TemporalSpeedStats, SlotSpeedCounts
+from random_streams import as_generator
 
 class IntraRoadSimulator:
-    def __init__(self, road: Road):
-        """This method stores the input agents and initializes output data"""
+    def __init__(self, road: Road, state_backend="objects", keep_speed_traces=False, speed_histograms=False, rng=None, seed=None):
+        """This method stores the input agents and initializes output data.
+        rng is the np.random.Generator of the run (np.random.default_rng(seed) otherwise), used by the vehicles and, unless
+        given their own, by the passenger and integrated simulators. An np.random.RandomState is also accepted and draws the
+        legacy streams (see random_streams.LegacyRandomState). The global np.random state is never read, so np.random.seed
+        does not control a run: pass seed or rng instead
+        state_backend is "objects" (every vehicle keeps its own attributes) or "arrays" (vehicle state is stored in contiguous NumPy arrays)
+        keep_speed_traces keeps the full speed trace of every vehicle and speed_histograms counts its speeds, on top of the online statistics"""
+        if state_backend not in ("objects", "arrays"):
+            raise ValueError(f"Unknown vehicle state backend: {state_backend}")
         self.road = road  # Store the road instance
+        self.state_backend = state_backend
+        self.state = VehicleStateArrays() if state_backend == "arrays" else None
+        self.keep_speed_traces = keep_speed_traces
+        self.speed_histograms = speed_histograms
+        self.rng = as_generator(rng, seed)
+        self.moved_in_bulk = set() #Slots of the vehicles moved by the vectorized update since their last Vehicle.after_move (see catch_up)
+        self.bulk_speed_counts = SlotSpeedCounts(road.speed_limit) #Speeds the vectorized update added to the temporal speed statistics
         self.vehicles = []  # List to store vehicle instances
-        self.occupancy_history = [] # List to store the history of road occupancy states
         self.current_time = 0
 
         self.total_vehicles = 0
@@ -22,6 +40,7 @@ class IntraRoadSimulator:
         self.spawned_jeeps = 0
         self.spawned_vehicles = 0 
         self.spawned_vehicles_occupancy = 0
+        self.next_vehicle_id = 0 #ID of the next vehicle placed, reset at the start of every run
         self.unsuccessful_vehicle_placement_tries = 0
         # Initialize the throughput counter for a specific position (e.g., position 99)
         self.throughput_counter = Counter()  # Change position as needed
@@ -32,25 +51,12 @@ class IntraRoadSimulator:
 
 
     def update_occupancy(self, timestep):
-        """This method updates road occupancy based on vehicle position and length"""
+        """This method rebuilds the whole road occupancy based on vehicle position and length.
+        Vehicles keep the grid up to date themselves on every move (see Vehicle.update_footprint), so this is only needed to resynchronize the grid."""
         self.road.occupancy.fill(0)
         for vehicle in self.vehicles:
-            x_start = vehicle.rear_bumper_position
-            x_end = (vehicle.rear_bumper_position + vehicle.length) % self.road.length #from vehicle rear bumper(position|) to front, minus 1. takes account of toroidal boundaries
-            y_start = vehicle.current_row
-            y_end = min(vehicle.current_row + vehicle.width, self.road.width)
-            if x_start < x_end:
-                if vehicle.vehicle_type == "jeep":
-                    self.road.occupancy[x_start:x_end, y_start:y_end] = 1
-                else:
-                    self.road.occupancy[x_start:x_end, y_start:y_end] = 2
-            else:
-                if vehicle.vehicle_type == "jeep":
-                    self.road.occupancy[x_start:, y_start:y_end] = 1
-                    self.road.occupancy[:x_end, y_start:y_end] = 1
-                else:
-                    self.road.occupancy[x_start:, y_start:y_end] = 2
-                    self.road.occupancy[:x_end, y_start:y_end] = 2
+            vehicle.painted_footprint = None
+            vehicle.update_footprint()
         
         
     # def compute_lane_occupancy(self):
@@ -66,6 +72,67 @@ class IntraRoadSimulator:
     #     return lane_1_occupancy, lane_2_occupancy
 
 
+    def shuffle_update_order(self):
+        """Randomizes the order in which vehicles are updated (random sequential update) and returns the vehicles in that order"""
+        if self.state is None:
+            self.rng.shuffle(self.vehicles)
+            return self.vehicles
+        return self.vehicles_in_update_order(self.state.shuffle_order(self.rng))
+
+    def vehicles_in_update_order(self, order=None):
+        """Returns the vehicles in the current update order"""
+        if self.state is None:
+            return self.vehicles
+        order = self.state.order if order is None else order
+        return [self.vehicles[slot] for slot in order]
+
+    def gaps_ahead(self, slots):
+        """Number of free cells in front of the vehicles in the given slots on their own lane (same as Vehicle.gap_distance without the look-ahead cap)"""
+        return parallel_update.gaps_ahead(self.road.occupancy[None], VehicleStateBatch.view_of(self.state), np.zeros(len(slots), dtype=np.int64), slots)
+
+    def parallel_update(self, slots):
+        """NaSch-style synchronous update of the vehicles in the given slots of the state arrays:
+        accelerate, gap-limited decelerate, random slowdown and move in one vectorized pass"""
+        parallel_update.advance(self.road.occupancy[None], VehicleStateBatch.view_of(self.state), np.zeros(len(slots), dtype=np.int64), slots, [self.rng])
+        self.after_parallel_update(slots)
+        return
+
+    def store_state(self, slots=None):
+        """Copies the attributes the per-vehicle rules change into the state arrays (arrays backend), for the vehicles in the given slots or all of them"""
+        if self.state is not None:
+            self.state.store(self.vehicles, slots)
+
+    def after_parallel_update(self, slots):
+        """Copies the new positions and speeds of the vehicles moved by the vectorized update back into them (the lane rings
+        read the positions). Their other per-vehicle bookkeeping only matters to their own per-vehicle rules and waits for catch_up."""
+        self.state.load(self.vehicles, slots)
+        self.moved_in_bulk.update(slots.tolist())
+
+    def add_bulk_speeds(self, slots):
+        """Adds the speeds of the vehicles in the given slots to their temporal speed statistics, counted in bulk_speed_counts
+        until settle_bulk_vehicles (one by one when the traces are kept, they need the order of the samples)"""
+        if self.keep_speed_traces:
+            for vehicle, speed in zip([self.vehicles[slot] for slot in slots], self.state.speed[slots].tolist()):
+                vehicle.temporal_speed_stats.add(speed)
+        else:
+            self.bulk_speed_counts.add(slots, self.state.speed[slots])
+
+    def catch_up(self, vehicle):
+        """Per-vehicle bookkeeping (stops, bumpers, occupied positions, painted footprint) a vehicle skipped while the vectorized
+        update moved it, run before its per-vehicle rules. It depends on the last move only, so running it once is enough."""
+        if vehicle.slot in self.moved_in_bulk:
+            self.moved_in_bulk.discard(vehicle.slot)
+            vehicle.after_move()
+            vehicle.painted_footprint = (vehicle.rear_bumper_position, vehicle.current_row)
+
+    def settle_bulk_vehicles(self):
+        """Catches up every vehicle moved by the vectorized update and passes the bulk speed counts to their statistics"""
+        if self.state is None:
+            return
+        for vehicle in self.vehicles:
+            self.catch_up(vehicle)
+            vehicle.temporal_speed_stats.add_counts(self.bulk_speed_counts.take(vehicle.slot))
+
     def compute_lane_occupancy(self, lane_start_row):
         """Computes the occupancy fraction for a given lane."""
         lane_width = 2  # Each lane is 2 cells wide
@@ -83,23 +150,30 @@ class IntraRoadSimulator:
     def place_one_vehicle(self, vehicle_initial_rear_bumper_position, vehicle_initial_row, vehicle_type, length, width, safe_stopping_speed, safe_deceleration, adjacent_sidewalk):
          #This position that position is correct and already determined
         
-        speed = np.random.randint(0,5)
-        randomize_lane_change_prob = np.random.rand()
+        speed = self.rng.integers(0,5)
+        randomize_lane_change_prob = self.rng.random()
         if self.road.occupancy[vehicle_initial_rear_bumper_position:(vehicle_initial_rear_bumper_position+length), vehicle_initial_row:(vehicle_initial_row+width)].sum() == 0:
-            new_vehicle = Vehicle(vehicle_initial_rear_bumper_position, speed, self.road.speed_limit,
+            vehicle_args = (vehicle_initial_rear_bumper_position, speed, self.road.speed_limit,
                     length, width, self.road, vehicle_type, vehicle_initial_row, 
                     randomize_lane_change_prob, adjacent_sidewalk, safe_stopping_speed, safe_deceleration)
+            if self.state is None:
+                new_vehicle = Vehicle(*vehicle_args, rng=self.rng, vehicle_id=self.next_vehicle_id)
+            else:
+                new_vehicle = ArrayBackedVehicle(self.state, *vehicle_args, rng=self.rng, vehicle_id=self.next_vehicle_id)
+            self.next_vehicle_id += 1
+            if self.keep_speed_traces or self.speed_histograms:
+                histogram_size = self.road.speed_limit + 1 if self.speed_histograms else None
+                new_vehicle.temporal_speed_stats = TemporalSpeedStats(keep_trace=self.keep_speed_traces, histogram_size=histogram_size)
             # Add new vehicle to list of vehicles present in the road
             self.vehicles.append(new_vehicle)
             # Mark the road occupancy record to set where the new vehicle was
             # placed as occupied.
+            new_vehicle.update_footprint()
             if vehicle_type == 'jeep':
-                self.road.occupancy[vehicle_initial_rear_bumper_position:(vehicle_initial_rear_bumper_position+length), vehicle_initial_row:(vehicle_initial_row + width)] = 1
                 self.spawned_jeeps +=1
                 self.spawned_vehicles_occupancy += 6
                 return True
             else: # Vehicle type is truck
-                self.road.occupancy[vehicle_initial_rear_bumper_position:(vehicle_initial_rear_bumper_position+length), vehicle_initial_row:(vehicle_initial_row+width)] = 2
                 self.spawned_trucks +=1
                 self.spawned_vehicles_occupancy += 14
                 return True
@@ -115,7 +189,7 @@ class IntraRoadSimulator:
         row_options = jeepney_allowed_rows if vehicle_type == 'jeep' else truck_allowed_rows
 
         # Pick a random starting row
-        row = np.random.choice(row_options)
+        row = self.rng.choice(row_options)
 
         # Compute occupancy for each allowed row
         row_occupancies = {r: self.compute_lane_occupancy(r) for r in row_options}
@@ -167,6 +241,8 @@ class IntraRoadSimulator:
         self.total_vehicles = N
         self.total_trucks = truck_count
         self.total_jeeps = jeep_count
+        if self.state is not None:
+            self.state.reserve(N)
 
         self.spawned_vehicles = self.spawned_jeeps + self.spawned_trucks
         return
@@ -0,0 +1,126 @@
+from operator import attrgetter
+
+import numpy as np
+
+from vehicle import Vehicle
+
+VEHICLE_TYPES = ("none", "jeep", "truck") #Index of each vehicle type is its code in the state arrays (same codes as the road occupancy)
+VEHICLE_TYPE_CODES = {vehicle_type: code for code, vehicle_type in enumerate(VEHICLE_TYPES)}
+
+
+class VehicleStateArrays:
+    """Struct-of-arrays storage of the vehicle state: one slot per vehicle, one contiguous NumPy array per attribute"""
+    integer_fields = ("rear_bumper_position", "previous_rear_bumper_position", "speed", "max_speed", "length", "width",
+                      "current_row", "occupied_seats", "capacity")
+    float_fields = ("lane_changing_prob", "braking_prob")
+
+    fields = ("vehicle_type",) + integer_fields + float_fields
+    mutable_fields = ("rear_bumper_position", "previous_rear_bumper_position", "speed", "current_row", "occupied_seats") #Changed by the per-vehicle rules
+    moved_fields = ("rear_bumper_position", "previous_rear_bumper_position", "speed") #Changed by the vectorized update
+
+    def __init__(self, capacity=0):
+        self.count = 0 #Number of slots in use
+        self.vehicle_type = np.zeros(capacity, dtype=np.int8)
+        for name in self.integer_fields:
+            setattr(self, name, np.zeros(capacity, dtype=np.int64))
+        for name in self.float_fields:
+            setattr(self, name, np.zeros(capacity, dtype=np.float64))
+        self.order = np.arange(0) #Random sequential update order, a permutation of the slots in use
+        self.bound = False #True when the arrays are rows of a VehicleStateBatch and cannot be reallocated
+
+    def reserve(self, capacity):
+        """Grows every array so that it can hold at least the given number of vehicles"""
+        current_capacity = self.vehicle_type.shape[0]
+        if capacity <= current_capacity:
+            return
+        if self.bound:
+            raise ValueError(f"Cannot grow a vehicle state bound to a batch beyond its {current_capacity} slots")
+        for name in self.fields:
+            old_array = getattr(self, name)
+            new_array = np.zeros(capacity, dtype=old_array.dtype)
+            new_array[:current_capacity] = old_array
+            setattr(self, name, new_array)
+
+    def allocate(self):
+        """Returns the slot of a new vehicle and appends it at the end of the update order"""
+        if self.count == self.vehicle_type.shape[0]:
+            self.reserve(max(1, 2 * self.count))
+        slot = self.count
+        self.count += 1
+        self.order = np.append(self.order, slot)
+        return slot
+
+    def shuffle_order(self, rng):
+        """Randomizes the update order in place with the np.random.Generator rng (same draws as shuffling the list of vehicles)"""
+        rng.shuffle(self.order)
+        return self.order
+
+    def store(self, vehicles, slots=None, names=mutable_fields):
+        """Copies attributes of the vehicles into the arrays. vehicles holds the vehicle of every slot in use, slots restricts
+        the copy to some of them (every slot in use by default)"""
+        if slots is None:
+            slots = slice(0, self.count)
+        else:
+            vehicles = [vehicles[slot] for slot in slots]
+        for name in names:
+            getattr(self, name)[slots] = list(map(attrgetter(name), vehicles))
+
+    def load(self, vehicles, slots, names=moved_fields):
+        """Copies the arrays of the given slots back into the attributes of their vehicles"""
+        columns = [getattr(self, name)[slots].tolist() for name in names]
+        for slot, values in zip(slots.tolist(), zip(*columns)):
+            vehicle = vehicles[slot]
+            for name, value in zip(names, values):
+                setattr(vehicle, name, value)
+
+    def active(self, name):
+        """Returns the array of an attribute restricted to the slots in use"""
+        return getattr(self, name)[:self.count]
+
+
+class VehicleStateBatch:
+    """Vehicle state of several replicas stacked along a leading replica axis: one (replicas x slots) array per attribute.
+    The arrays of each replica's VehicleStateArrays become row views of the batch arrays, so the per-vehicle rules and the
+    vectorized rules read and write the same memory."""
+
+    def __init__(self, states, capacity=None):
+        if capacity is None:
+            capacity = max(state.vehicle_type.shape[0] for state in states)
+        self.states = states
+        for name in VehicleStateArrays.fields:
+            dtype = getattr(states[0], name).dtype
+            batch_array = np.zeros((len(states), capacity), dtype=dtype)
+            for replica, state in enumerate(states):
+                state_array = getattr(state, name)
+                batch_array[replica, :state_array.shape[0]] = state_array
+                setattr(state, name, batch_array[replica]) #Rebind the replica's array to its row of the batch
+            setattr(self, name, batch_array)
+        for state in states:
+            state.bound = True
+
+    @classmethod
+    def view_of(cls, state):
+        """Single-replica batch sharing the arrays of one VehicleStateArrays (no copy, the state stays unbound)"""
+        batch = cls.__new__(cls)
+        batch.states = [state]
+        for name in VehicleStateArrays.fields:
+            setattr(batch, name, getattr(state, name)[None, :])
+        return batch
+
+    def counts(self):
+        """Number of slots in use in each replica"""
+        return np.array([state.count for state in self.states])
+
+
+class ArrayBackedVehicle(Vehicle):
+    """Vehicle with a slot in a VehicleStateArrays. Its attributes stay plain instance attributes, the per-vehicle rules read
+    and write them as for a Vehicle, and the arrays are synced with them where the vectorized code reads them
+    (see VehicleStateArrays.store and load)."""
+
+    def __init__(self, state, *args, **kwargs):
+        self.state = state
+        self.slot = state.allocate()
+        super().__init__(*args, **kwargs)
+        state.vehicle_type[self.slot] = VEHICLE_TYPE_CODES[self.vehicle_type]
+        for name in state.integer_fields + state.float_fields:
+            getattr(state, name)[self.slot] = getattr(self, name)
@@ -0,0 +1,125 @@
+import json
+import os
+import socket
+import threading
+
+QUEUE_STATES = ("pending", "running", "done", "failed")
+
+
+class WorkQueue:
+    """Task queue kept in a directory of a shared filesystem (NFS included), for workers on any number of nodes.
+    A task is one JSON file that moves between the pending, running, done and failed subfolders by rename, which is atomic:
+    a worker claims a task by renaming it into running/ under its own name, so two workers never get the same task.
+    While it runs, the worker touches its running file every heartbeat_seconds. A running file that was not touched for
+    stale_seconds belongs to a dead worker and goes back to pending/. Times are read from the file server's clock."""
+
+    def __init__(self, directory, heartbeat_seconds=30, stale_seconds=None):
+        self.directory = directory
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds if stale_seconds is not None else 5 * heartbeat_seconds
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        for state in QUEUE_STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+        self.clock_path = os.path.join(directory, f"clock-{self.worker}")
+
+    def _path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def names(self, state):
+        return sorted(name for name in os.listdir(os.path.join(self.directory, state)) if name.endswith(".json"))
+
+    def counts(self):
+        return {state: len(self.names(state)) for state in QUEUE_STATES}
+
+    def now(self):
+        """Current time of the file server (the clocks of the nodes may differ)"""
+        with open(self.clock_path, "w"):
+            pass
+        return os.stat(self.clock_path).st_mtime
+
+    def enqueue(self, tasks):
+        """Adds the tasks (JSON-serialisable dicts) as pending, claimed in the given order.
+        Raises ValueError when the queue still has pending or running tasks."""
+        counts = self.counts()
+        if counts["pending"] or counts["running"]:
+            raise ValueError(f"The queue in {self.directory} still has {counts['pending']} pending and {counts['running']} running tasks")
+        first = sum(counts.values())
+        for index, task in enumerate(tasks, start=first):
+            name = f"{index:07d}.json"
+            partial_path = self._path("pending", f".{name}.partial")
+            with open(partial_path, "w") as task_file:
+                json.dump(task, task_file)
+            os.replace(partial_path, self._path("pending", name))
+
+    def claim(self):
+        """Claims the first pending task, returns (claim name, task) or None when nothing is pending"""
+        for name in self.names("pending"):
+            claim_name = f"{name[:-len('.json')]}@{self.worker}.json"
+            try:
+                os.utime(self._path("pending", name)) #A fresh heartbeat before the task shows up as running
+                os.rename(self._path("pending", name), self._path("running", claim_name))
+            except FileNotFoundError: #Claimed by another worker
+                continue
+            with open(self._path("running", claim_name)) as task_file:
+                return claim_name, json.load(task_file)
+        return None
+
+    def heartbeat(self, claim_name):
+        """Marks a claimed task as alive, returns False when it was requeued meanwhile"""
+        try:
+            os.utime(self._path("running", claim_name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def finish(self, claim_name, error=None):
+        """Moves a claimed task to done/, or to failed/ with the traceback of its error next to it"""
+        name = claim_name.split("@")[0] + ".json"
+        state = "done" if error is None else "failed"
+        if error is not None:
+            with open(self._path("failed", name[:-len(".json")] + ".txt"), "w") as error_file:
+                error_file.write(error)
+        for source in (self._path("running", claim_name), self._path("pending", name)): #Requeued meanwhile: take it back
+            try:
+                os.rename(source, self._path(state, name))
+                return
+            except FileNotFoundError:
+                continue
+
+    def requeue_stale(self):
+        """Moves the running tasks whose worker stopped heartbeating back to pending, returns their count"""
+        now = self.now()
+        requeued = 0
+        for claim_name in self.names("running"):
+            path = self._path("running", claim_name)
+            try:
+                if now - os.stat(path).st_mtime < self.stale_seconds:
+                    continue
+                os.rename(path, self._path("pending", claim_name.split("@")[0] + ".json"))
+            except FileNotFoundError: #Finished or requeued by another worker
+                continue
+            requeued += 1
+        return requeued
+
+    def close(self):
+        try:
+            os.remove(self.clock_path)
+        except FileNotFoundError:
+            pass
+
+
+class Heartbeat:
+    """Background thread heartbeating a claimed task until stopped"""
+
+    def __init__(self, work_queue, claim_name):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(work_queue, claim_name), name="heartbeat", daemon=True)
+        self.thread.start()
+
+    def _run(self, work_queue, claim_name):
+        while not self.stopped.wait(work_queue.heartbeat_seconds):
+            work_queue.heartbeat(claim_name)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()